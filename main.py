@@ -9,141 +9,223 @@ import imaplib
 import email
 import html
 import re
-import requests
-import xml.etree.ElementTree as ET
+import importlib
+import importlib.util
 from datetime import datetime
 import time
-import pytesseract
-from PIL import Image
 from email.header import decode_header
 import subprocess
 import zipfile
+import tarfile
+import gzip
 import tempfile
 import shutil
 import csv
 import hashlib
-from bs4 import BeautifulSoup
-from PyPDF2 import PdfReader
-import docx2txt
-import openpyxl
+import sqlite3
+import asyncio
+import functools
+import random
+import threading
+import multiprocessing
+import sys
+from collections import deque
+from queue import Queue, Empty
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED,
+                                BrokenExecutor, CancelledError)
+
+_startup_started = time.perf_counter()
 
 
 #---------------------
 #GLOBALS
 #---------------------
-last_email_hash = None
 synonyms_type = None
 logs = 1 #1 - логи полноценные, 0 - без
 
+# =============================
+# Ленивая загрузка тяжёлых зависимостей
+# =============================
+# OCR, PDF, Office, HTML-парсеры и requests импортируются при первом обращении к ним:
+# процесс, которому попадаются только текстовые письма, эти библиотеки не загружает вовсе.
+class LazyModule:
+    """Заглушка модуля: настоящий импорт выполняется при первом обращении к атрибуту."""
+
+    def __init__(self, name: str, on_load=None):
+        self._name = name
+        self._on_load = on_load
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                started = time.perf_counter()
+                module = importlib.import_module(self._name)
+                if self._on_load:
+                    self._on_load(module)
+                self._module = module
+                logging.debug(f"Модуль {self._name} загружен за {time.perf_counter() - started:.2f} с")
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+def _configure_tesseract(module):
+    # Путь к Tesseract берётся из конфига, затем из PATH (Linux-воркеры), затем стандартный путь Windows
+    module.pytesseract.tesseract_cmd = (config.get("TESSERACT_CMD")
+                                        or shutil.which("tesseract")
+                                        or r"C:\Program Files\Tesseract-OCR\tesseract.exe")
+
+
+requests = LazyModule("requests")
+pytesseract = LazyModule("pytesseract", on_load=_configure_tesseract)
+Image = LazyModule("PIL.Image")
+ImageOps = LazyModule("PIL.ImageOps")
+bs4 = LazyModule("bs4")
+PyPDF2 = LazyModule("PyPDF2")
+docx2txt = LazyModule("docx2txt")
+openpyxl = LazyModule("openpyxl")
+lxml_html = LazyModule("lxml.html")
+
+# Необязательные зависимости: наличие проверяется без импорта
+LXML_AVAILABLE = importlib.util.find_spec("lxml") is not None
+WIN32_AVAILABLE = importlib.util.find_spec("win32com") is not None
+
 # -----------------------------
-# Настройка логирования и OCR
+# Настройка конфига, логирования и правил разбора (выполняется в init)
 # -----------------------------
-import logging
-import os
-from datetime import datetime
+config = {}
+REGEX_PATTERNS = {}
+PART_SPECIFICATIONS = {}
+
+# Уровень логирования
+# для детальной отладки парсинга лучше поставить DEBUG
+log_level = logging.DEBUG
+
+# Формат сообщений (добавил имя файла и строку для удобства отладки)
+log_format = "%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s"
+formatter = logging.Formatter(log_format)
+
 
 # --- Настройка конфига ---
 def load_config(path="config.json") -> dict:
     with open(path, "r", encoding="utf-8-sig") as f:
         return json.load(f)
 
-config = load_config()
 
-#Загрузка путей
-regex = config["REGEX_PATH"]
-parameters = config["PARAMETERS_PATH"]
-synonyms_data = config["SYNONYMS_PATH"]
+def setup_logging(config: dict):
+    # ---- НАСТРОЙКА ВЫВОДА В КОНСОЛЬ ----
+    logger = logging.getLogger()
+    logger.setLevel(log_level)
 
-# Уровень логирования
-# для детальной отладки парсинга лучше поставить DEBUG
-log_level = logging.DEBUG
+    # Обработчик для вывода в консоль (терминал)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(log_level)  # Уровень для консоли
+    console_handler.setFormatter(formatter)  # Формат для консоли
+    if not any(isinstance(h, logging.StreamHandler) for h in logger.handlers):  # Добавляем, если еще нет
+        logger.addHandler(console_handler)
 
-# Формат сообщений (добавил имя файла и строку для удобства отладки)
-log_format = "%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s"
-formatter = logging.Formatter(log_format)
+    # ---- НАСТРОЙКА ВЫВОДА В ФАЙЛ ----
+    log_directory = config["LOGS_FOLDER"]  # Путь к папке логов (raw string для Windows)
+    log_file_name = f"order_processing_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"  # Имя файла с датой и временем
+    log_file_path = os.path.join(log_directory, log_file_name)
 
-# ---- НАСТРОЙКА ВЫВОДА В КОНСОЛЬ ----
-logger = logging.getLogger()
-logger.setLevel(log_level)
-
-
-
-# Обработчик для вывода в консоль (терминал)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(log_level)  # Уровень для консоли
-console_handler.setFormatter(formatter)  # Формат для консоли
-if not any(isinstance(h, logging.StreamHandler) for h in logger.handlers):  # Добавляем, если еще нет
-    logger.addHandler(console_handler)
-
-# ---- НАСТРОЙКА ВЫВОДА В ФАЙЛ ----
-log_directory = config["LOGS_FOLDER"]  # Путь к папке логов (raw string для Windows)
-log_file_name = f"order_processing_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"  # Имя файла с датой и временем
-log_file_path = os.path.join(log_directory, log_file_name)
-
-try:
-    if not os.path.exists(log_directory):
-        os.makedirs(log_directory)
-        print(
-            f"INFO: Создана папка для логов: {log_directory}")  # Используем print, т.к. логгер может быть еще не готов
-except OSError as e:
-    print(f"ERROR: Не удалось создать папку для логов {log_directory}: {e}")
-
-try:
-    import win32com.client
-    WIN32_AVAILABLE = True
-except ImportError:
-    WIN32_AVAILABLE = False
-    logging.warning("Библиотека pywin32 не найдена. Обработка .doc файлов будет недоступна.")
-
-try:
-    with open(regex, 'r', encoding='utf-8') as f:
-        REGEX_PATTERNS = json.load(f)
-    logging.info("Словарь регулярных выражений успешно загружен.")
-except Exception as e:
-    logging.error(f"Не удалось загрузить regex_patterns.json: {e}")
-    REGEX_PATTERNS = {} # Создаем пустой словарь, чтобы скрипт не упал
-
-try:
-    file_handler = logging.FileHandler(log_file_path, mode='a', encoding='utf-8')
-    file_handler.setLevel(log_level)
-    file_handler.setFormatter(formatter)
-    if not any(isinstance(h, logging.FileHandler) and h.baseFilename == file_handler.baseFilename for h in
-               logger.handlers):
-        logger.addHandler(file_handler)
-
-    logging.info(f"Логирование в файл настроено: {log_file_path}")
-
-except Exception as e:
-    logging.error(f"Ошибка настройки логирования в файл {log_file_path}: {e}", exc_info=True)
-
-# --- Остальные настройки OCR и т.д. ---
-pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-
-
-
-
-try:
-    with open(synonyms_data, 'r', encoding='utf-8') as f:
-        synonyms_type = json.load(f)
-    if synonyms_type:
-        print("Словарь синонимов успешно загружен:")
-        if "тройник" in synonyms_type:
-            print(f"Синонимы для 'тройник': {synonyms_type['тройник']}")
-    else:
-        print("Не удалось загрузить данные, переменная synonyms_type пуста.")
+    try:
+        if not os.path.exists(log_directory):
+            os.makedirs(log_directory)
+            print(
+                f"INFO: Создана папка для логов: {log_directory}")  # Используем print, т.к. логгер может быть еще не готов
+    except OSError as e:
+        print(f"ERROR: Не удалось создать папку для логов {log_directory}: {e}")
+
+    try:
+        file_handler = logging.FileHandler(log_file_path, mode='a', encoding='utf-8')
+        file_handler.setLevel(log_level)
+        file_handler.setFormatter(formatter)
+        if not any(isinstance(h, logging.FileHandler) and h.baseFilename == file_handler.baseFilename for h in
+                   logger.handlers):
+            logger.addHandler(file_handler)
+
+        logging.info(f"Логирование в файл настроено: {log_file_path}")
+
+    except Exception as e:
+        logging.error(f"Ошибка настройки логирования в файл {log_file_path}: {e}", exc_info=True)
+
+
+def load_rules(config: dict):
+    """Загружает regex-правила, словарь синонимов и спецификации деталей по путям из конфига."""
+    global REGEX_PATTERNS, PART_SPECIFICATIONS, synonyms_type
+
+    #Загрузка путей
+    regex = config["REGEX_PATH"]
+    parameters = config["PARAMETERS_PATH"]
+    synonyms_data = config["SYNONYMS_PATH"]
+
+    try:
+        with open(regex, 'r', encoding='utf-8') as f:
+            REGEX_PATTERNS = json.load(f)
+        logging.info("Словарь регулярных выражений успешно загружен.")
+    except Exception as e:
+        logging.error(f"Не удалось загрузить regex_patterns.json: {e}")
+        REGEX_PATTERNS = {} # Создаем пустой словарь, чтобы скрипт не упал
+
+    try:
+        with open(synonyms_data, 'r', encoding='utf-8') as f:
+            synonyms_type = json.load(f)
+        if synonyms_type:
+            print("Словарь синонимов успешно загружен:")
+            if "тройник" in synonyms_type:
+                print(f"Синонимы для 'тройник': {synonyms_type['тройник']}")
+        else:
+            print("Не удалось загрузить данные, переменная synonyms_type пуста.")
+
+    except FileNotFoundError:
+        print(f"Ошибка: Файл '{synonyms_data}' не найден. Убедитесь, что файл существует и путь указан верно.")
+    except json.JSONDecodeError:
+        print(f"Ошибка: Не удалось декодировать JSON из файла '{synonyms_data}'. Проверьте корректность формата JSON в файле.")
+    except Exception as e:
+        print(f"Произошла непредвиденная ошибка: {e}")
+
+    with open(parameters, 'r', encoding='utf-8') as f:
+        PART_SPECIFICATIONS = json.load(f)
 
-except FileNotFoundError:
-    print(f"Ошибка: Файл '{synonyms_data}' не найден. Убедитесь, что файл существует и путь указан верно.")
-except json.JSONDecodeError:
-    print(f"Ошибка: Не удалось декодировать JSON из файла '{synonyms_data}'. Проверьте корректность формата JSON в файле.")
-except Exception as e:
-    print(f"Произошла непредвиденная ошибка: {e}")
+
+def current_rss_mb() -> float | None:
+    """Текущий RSS процесса в МБ: /proc на Linux, psutil (если установлен) на остальных системах."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        return None
 
 
-# Вставьте этот блок после блока "GLOBALS" или перед функцией load_config
+def init(config_path: str = "config.json") -> dict:
+    """
+    Загружает конфиг, настраивает логирование и читает правила разбора.
+    Импорт модуля побочных эффектов не имеет - init вызывается явно при запуске.
+    """
+    config.clear()
+    config.update(load_config(config_path))
+    setup_logging(config)
+    if not LXML_AVAILABLE:
+        logging.info("Библиотека lxml не найдена. HTML-письма разбираются через html.parser.")
+    if not WIN32_AVAILABLE:
+        logging.warning("Библиотека pywin32 не найдена. Обработка .doc файлов будет недоступна.")
+    load_rules(config)
+
+    rss = current_rss_mb()
+    logging.info(f"Инициализация завершена за {time.perf_counter() - _startup_started:.2f} с с момента запуска, "
+                 f"память процесса: {f'{rss:.0f} МБ' if rss is not None else 'н/д'}")
+    return config
 
-with open(parameters, 'r', encoding='utf-8') as f:
-    PART_SPECIFICATIONS = json.load(f)
 
 material_aliases = {
     "ст3": ["ст3", "ст.3", "сталь 3", "ст3сп", "ст3пс", "ст3кп", "s235jr", "s235", "st37-2", "q235", "a36"],
@@ -299,10 +381,59 @@ def extract_key_features(name: str) -> dict:
     return features
 
 
+class NomenclatureIndex:
+    """
+    Индекс номенклатуры для find_best_match: позиции по ключевому слову типа и результат
+    parse_order_name для каждой позиции считаются один раз, а не при каждом поиске.
+    Номенклатура после загрузки не меняется, поэтому индекс только дополняется.
+    """
+
+    def __init__(self, nomenclature_data: list[dict]):
+        self.items = nomenclature_data
+        self.names_lower = [item.get('Полное наименование', '').lower() for item in nomenclature_data]
+        self.by_keyword = {}
+        self.parsed_params = {}
+
+    def candidates(self, keyword: str) -> list[int]:
+        positions = self.by_keyword.get(keyword)
+        if positions is None:
+            positions = [i for i, name in enumerate(self.names_lower) if keyword in name]
+            self.by_keyword[keyword] = positions
+        return positions
+
+    def params(self, position: int) -> dict:
+        params = self.parsed_params.get(position)
+        if params is None:
+            params = parse_order_name(self.items[position].get('Полное наименование', '')).get("params", {})
+            self.parsed_params[position] = params
+        return params
+
+    def warm(self):
+        """Заранее разбирает позиции всех типов из словаря синонимов (перед запуском воркеров сервиса)."""
+        for product_type, synonyms in (synonyms_type or {}).items():
+            if product_type.lower() == "комментарий" or not synonyms:
+                continue
+            for position in self.candidates(synonyms[0].lower()):
+                self.params(position)
+
+
+_nomenclature_index = None
+
+
+def get_nomenclature_index(nomenclature_data: list[dict]) -> NomenclatureIndex:
+    global _nomenclature_index
+    index = _nomenclature_index
+    if index is None or index.items is not nomenclature_data:
+        index = NomenclatureIndex(nomenclature_data)
+        _nomenclature_index = index
+    return index
+
+
 def find_best_match(order_product_name: str, nomenclature_data: list[dict]) -> dict | None:
     """
     ФИНАЛЬНАЯ ГИБРИДНАЯ ВЕРСИЯ.
     Использует строгую фильтрацию по размерам для максимальной точности.
+    Разбор позиций номенклатуры берётся из NomenclatureIndex.
     """
     parsed_order_info = parse_order_name(order_product_name)
 
@@ -318,22 +449,19 @@ def find_best_match(order_product_name: str, nomenclature_data: list[dict]) -> d
 
 
     filter_keyword = synonyms_type.get(order_type, [order_type])[0].lower()
-    candidates = [
-        item for item in nomenclature_data
-        if filter_keyword in item.get('Полное наименование', '').lower()
-    ]
+    index = get_nomenclature_index(nomenclature_data)
+    candidates = index.candidates(filter_keyword)
 
     if not candidates:
         return None
 
     strict_candidates = []
     if order_dimensions:
-        for item in candidates:
-            item_info = parse_order_name(item.get('Полное наименование', ''))
-            item_dimensions = item_info.get("params", {}).get("dimensions")
+        for position in candidates:
+            item_dimensions = index.params(position).get("dimensions")
 
             if order_dimensions == item_dimensions:
-                strict_candidates.append(item)
+                strict_candidates.append(position)
 
         if not strict_candidates:
             logging.warning(
@@ -346,10 +474,9 @@ def find_best_match(order_product_name: str, nomenclature_data: list[dict]) -> d
     best_score = -1
     best_match = None
 
-    for item in candidates:
+    for position in candidates:
         current_score = 0
-        item_info = parse_order_name(item.get('Полное наименование', ''))
-        item_params = item_info.get("params", {})
+        item_params = index.params(position)
 
         for key, order_value in order_params.items():
             if key != 'dimensions' and item_params.get(key) == order_value:
@@ -357,7 +484,7 @@ def find_best_match(order_product_name: str, nomenclature_data: list[dict]) -> d
 
         if current_score > best_score:
             best_score = current_score
-            best_match = item
+            best_match = index.items[position]
 
     if best_match:
         logging.debug(
@@ -519,78 +646,151 @@ def parse_order_name(order_name: str) -> dict:
 # =============================
 # Функции для работы с файлами и сохранения XML
 # =============================
-def save_order_xml(xml_text: str, folder, base_filename, overwrite=False):
-    if not os.path.exists(folder):
-        try:
-            os.makedirs(folder)
-            logging.info(f"Создана папка {folder}")
-        except Exception as e:
-            logging.error(f"Не удалось создать папку {folder}: {e}")
-            return
-    save_path = os.path.join(folder, base_filename)
-    if not overwrite and os.path.exists(save_path):
-        index = 1
-        while True:
-            new_filename = f"{os.path.splitext(base_filename)[0]}_{index}{os.path.splitext(base_filename)[1]}"
-            new_path = os.path.join(folder, new_filename)
-            if not os.path.exists(new_path):
-                save_path = new_path
-                break
-            index += 1
+def ensure_folder(folder: str) -> bool:
+    if os.path.isdir(folder):
+        return True
+    try:
+        os.makedirs(folder, exist_ok=True)
+        logging.info(f"Создана папка {folder}")
+        return True
+    except Exception as e:
+        logging.error(f"Не удалось создать папку {folder}: {e}")
+        return False
+
+
+def order_spool_folder(config: dict, folder: str) -> str:
+    """
+    Папка для недописанных файлов, своя для каждой папки назначения и по умолчанию рядом с ней:
+    os.replace атомарен только в пределах одного диска, а архив может лежать на сетевом ресурсе.
+    ORDER_SPOOL_FOLDER переопределяет спул только для папки заказов.
+    """
+    order_folder = config.get("ORDER_XML_FOLDER", r"C:\1s\docs")
+    if config.get("ORDER_SPOOL_FOLDER") and os.path.normpath(folder) == os.path.normpath(order_folder):
+        return config["ORDER_SPOOL_FOLDER"]
+    return os.path.normpath(folder) + "_spool"
+
+
+def save_order_xml(xml_parts: list, folder: str, filename: str, spool_folder: str) -> str | None:
+    """
+    Пишет XML во временный файл в папке спула и атомарно переносит его в folder (os.replace),
+    поэтому 1С никогда не видит наполовину записанный файл. Возвращает путь или None при ошибке.
+    """
+    if not ensure_folder(folder) or not ensure_folder(spool_folder):
+        return None
+    save_path = os.path.join(folder, filename)
+    tmp_path = None
     try:
-        with open(save_path, "w", encoding="utf-8") as f:
-            f.write(xml_text)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=spool_folder, suffix=".tmp",
+                                         delete=False) as f:
+            tmp_path = f.name
+            f.writelines(xml_parts)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, save_path)
         logging.info(f"XML-запрос сохранён в файл: {save_path}")
+        return save_path
     except Exception as e:
         logging.error(f"Ошибка сохранения XML: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return None
 
-def validate_xml(xml_text: str) -> bool:
-    try:
-        ET.fromstring(xml_text)
-        return True
-    except ET.ParseError as e:
-        logging.error(f"Ошибка валидации XML: {e}")
-        return False
+# Хэши заказов, уже сохранённых в архив, хранятся в SQLite (таблица order_hashes в файле журнала
+# LEDGER_PATH) и целиком загружаются в память при старте: проверка на дубль не обращается к диску.
+# Раньше на каждый заказ в ARCHIVE_FOLDER создавался пустой файл order_<md5>.marker - такие файлы
+# один раз переносятся в таблицу и удаляются.
+_order_dedup_index = None
+_order_dedup_lock = threading.Lock()
+
+
+class OrderDedupIndex:
+    """Множество MD5 архивных заказов в памяти с сохранением в SQLite."""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS order_hashes (hash BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+        self.conn.commit()
+        self.hashes = {row[0] for row in self.conn.execute("SELECT hash FROM order_hashes")}
+        logging.info(f"Загружено хэшей архивных заказов: {len(self.hashes)}")
+
+    def __contains__(self, order_hash: bytes) -> bool:
+        with self.lock:
+            return order_hash in self.hashes
+
+    def add(self, order_hash: bytes) -> bool:
+        """Добавляет хэш заказа; False - такой заказ уже есть в архиве."""
+        with self.lock:
+            if order_hash in self.hashes:
+                return False
+            self.conn.execute("INSERT OR IGNORE INTO order_hashes (hash) VALUES (?)", (order_hash,))
+            self.conn.commit()
+            self.hashes.add(order_hash)
+            return True
+
+    def migrate_markers(self, archive_folder: str):
+        """Однократный перенос файлов order_<md5>.marker из архива в таблицу."""
+        with self.lock:
+            done = self.conn.execute("SELECT value FROM meta WHERE name = 'markers_migrated'").fetchone()
+            if done or not os.path.isdir(archive_folder):
+                return
+            marker_paths = []
+            migrated = set()
+            with os.scandir(archive_folder) as entries:
+                for entry in entries:
+                    match = re.fullmatch(r"order_([0-9a-f]{32})\.marker", entry.name)
+                    if match:
+                        migrated.add(bytes.fromhex(match.group(1)))
+                        marker_paths.append(entry.path)
+            self.conn.executemany("INSERT OR IGNORE INTO order_hashes (hash) VALUES (?)",
+                                  ((order_hash,) for order_hash in migrated))
+            self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('markers_migrated', ?)",
+                              (datetime.now().isoformat(),))
+            self.conn.commit()
+            self.hashes.update(migrated)
+        logging.info(f"Перенесено маркеров заказов из {archive_folder}: {len(marker_paths)}")
+        for marker_path in marker_paths:
+            try:
+                os.remove(marker_path)
+            except OSError as e:
+                logging.warning(f"Не удалось удалить маркер {marker_path}: {e}")
 
-def is_duplicate_order(xml_text: str, archive_folder: str) -> bool:
-    order_hash = hashlib.md5(xml_text.encode("utf-8")).hexdigest()
-    marker_path = os.path.join(archive_folder, f"order_{order_hash}.marker")
-    if os.path.exists(marker_path):
-        return True
-    else:
-        try:
-            with open(marker_path, "w") as f:
-                f.write("")
-        except Exception as e:
-            logging.error(f"Ошибка создания маркера заказа: {e}")
-        return False
 
+def get_order_dedup_index(config: dict) -> OrderDedupIndex:
+    global _order_dedup_index
+    with _order_dedup_lock:
+        if _order_dedup_index is None:
+            _order_dedup_index = OrderDedupIndex(config.get("LEDGER_PATH", "ledger.db"))
+            _order_dedup_index.migrate_markers(config["ARCHIVE_FOLDER"])
+        return _order_dedup_index
 
-def generate_order_xml(order_data: dict, config: dict, nomenclature_data: list) -> str:
+
+def _order_hash(xml_text: str) -> bytes:
+    return hashlib.md5(xml_text.encode("utf-8")).digest()
+
+
+def is_duplicate_order(xml_text: str, config: dict) -> bool:
+    """Заказ уже есть в архиве. Индекс не меняет - хэш добавляет remember_archived_order после записи."""
+    return _order_hash(xml_text) in get_order_dedup_index(config)
+
+
+def remember_archived_order(xml_text: str, config: dict):
+    get_order_dedup_index(config).add(_order_hash(xml_text))
+
+
+def match_order_products(order_data: dict, nomenclature_data: list) -> list:
     """
-    Формирует XML-файл заказа, предварительно находя каждую позицию в номенклатуре.
+    Сопоставляет позиции заказа с номенклатурой.
+    Возвращает список {"code", "name", "quantity"} в порядке позиций заказа.
     """
-    products = order_data.get("order", {}).get("products", [])
-    company = order_data.get("company", {})
-    contact = order_data.get("order", {}).get("contact_person", {})
-    phone = extract_phone_number(contact.get("phone", ""))
-
-    xml = f"""<Заказ>
-  <Контрагент>
-    <ИНН>{company.get("INN", "")}</ИНН>
-    <КПП>{company.get("KPP", "")}</КПП>
-    <НаименованиеПолное>{html.escape(company.get("name", ""))}</НаименованиеПолное>
-    <НаименованиеКраткое>{html.escape(company.get("name", ""))}</НаименованиеКраткое>
-    <ЮрАдрес>{html.escape(company.get("legal_address", ""))}</ЮрАдрес>
-    <ФактАдрес>{html.escape(company.get("actual_address", ""))}</ФактАдрес>
-    <Телефон>{html.escape(phone)}</Телефон>
-    <Email>{html.escape(contact.get("email", ""))}</Email>
-    <КонтактноеЛицо>{html.escape(contact.get("full_name", ""))}</КонтактноеЛицо>
-  </Контрагент>
-  <Ответственный>{html.escape(contact.get("full_name", ""))}</Ответственный>
-  <Товары>
-"""
-    for prod in products:
+    matched_products = []
+    for prod in order_data.get("order", {}).get("products", []):
         prod_name = prod.get("full_name", prod.get("name", ""))
         prod_quantity = prod.get("quantity", 0)
 
@@ -610,66 +810,125 @@ def generate_order_xml(order_data: dict, config: dict, nomenclature_data: list)
             # Если совпадение не найдено, оставляем код пустым и используем исходное имя
             logging.warning(f"⚠️ НЕ НАЙДЕНО: Для '{prod_name}'. Позиция будет добавлена с оригинальным наименованием.")
 
-        xml += f"""    <Товар>
-          <Код>{html.escape(str(final_code))}</Код>
-          <ПолноеНаименование>{html.escape(final_name)}</ПолноеНаименование>
-          <Количество>{prod_quantity}</Количество>
-        </Товар>
-"""
-    xml += "  </Товары>\n</Заказ>"
-    logging.info("Сформированный XML заказа:\n%s", xml)
+        matched_products.append({"code": final_code, "name": final_name, "quantity": prod_quantity})
+    return matched_products
 
-    if not validate_xml(xml):
-        logging.error("XML невалиден – остановка обработки заказа.")
-        return xml
 
+# Символы, недопустимые в XML 1.0 (управляющие и суррогаты): с ними 1С не прочитает файл
+INVALID_XML_CHARS = re.compile(r"[^\u0009\u000A\u000D\u0020-\uD7FF\uE000-\uFFFD\U00010000-\U0010FFFF]")
+
+
+def xml_value(value) -> str:
+    """Экранирует значение для XML и сразу убирает недопустимые символы - отдельная проверка не нужна."""
+    text = str(value)
+    cleaned = INVALID_XML_CHARS.sub("", text)
+    if len(cleaned) != len(text):
+        logging.warning(f"Из значения '{cleaned[:50]}' удалены символы, недопустимые в XML.")
+    return html.escape(cleaned)
+
+
+def iter_order_xml(order_data: dict, matched_products: list):
+    """Построчно отдаёт XML заказа; значения экранируются по ходу, документ не собирается конкатенацией."""
+    company = order_data.get("company", {})
+    contact = order_data.get("order", {}).get("contact_person", {})
+    phone = extract_phone_number(contact.get("phone", ""))
+
+    yield "<Заказ>\n"
+    yield "  <Контрагент>\n"
+    yield f"    <ИНН>{xml_value(company.get('INN', ''))}</ИНН>\n"
+    yield f"    <КПП>{xml_value(company.get('KPP', ''))}</КПП>\n"
+    yield f"    <НаименованиеПолное>{xml_value(company.get('name', ''))}</НаименованиеПолное>\n"
+    yield f"    <НаименованиеКраткое>{xml_value(company.get('name', ''))}</НаименованиеКраткое>\n"
+    yield f"    <ЮрАдрес>{xml_value(company.get('legal_address', ''))}</ЮрАдрес>\n"
+    yield f"    <ФактАдрес>{xml_value(company.get('actual_address', ''))}</ФактАдрес>\n"
+    yield f"    <Телефон>{xml_value(phone)}</Телефон>\n"
+    yield f"    <Email>{xml_value(contact.get('email', ''))}</Email>\n"
+    yield f"    <КонтактноеЛицо>{xml_value(contact.get('full_name', ''))}</КонтактноеЛицо>\n"
+    yield "  </Контрагент>\n"
+    yield f"  <Ответственный>{xml_value(contact.get('full_name', ''))}</Ответственный>\n"
+    yield "  <Товары>\n"
+    for matched in matched_products:
+        yield (f"    <Товар>\n"
+               f"          <Код>{xml_value(matched['code'])}</Код>\n"
+               f"          <ПолноеНаименование>{xml_value(matched['name'])}</ПолноеНаименование>\n"
+               f"          <Количество>{xml_value(matched['quantity'])}</Количество>\n"
+               f"        </Товар>\n")
+    yield "  </Товары>\n</Заказ>"
+
+
+def next_order_filename(config: dict, existing: set) -> str:
+    """Имя zakaz_<N>.xml из постоянного счётчика в журнале - без перебора имён на диске."""
+    ledger = get_message_ledger(config)
+    while True:
+        filename = f"zakaz_{ledger.next_sequence('zakaz')}.xml"
+        # Файлы, оставшиеся от прежней схемы именования, не перезаписываем
+        if filename not in existing:
+            return filename
 
-    order_folder = config.get("ORDER_XML_FOLDER", r"C:\1s\docs")
-    if not os.path.exists(order_folder):
-        try:
-            os.makedirs(order_folder)
-            logging.info(f"Создана папка {order_folder}")
-        except Exception as e:
-            logging.error(f"Не удалось создать папку {order_folder}: {e}")
-            return xml
 
-    if os.listdir(order_folder):
-        cleanup_docs_folder_if_markers_exist(order_folder)
+class OrderSaveError(Exception):
+    """XML заказа не записан в папку для 1С - письмо нельзя считать обработанным."""
 
-    target_overwrite = True if not os.listdir(order_folder) else False
-    save_order_xml(xml, folder=order_folder, base_filename="zakaz.xml", overwrite=target_overwrite)
 
+def generate_order_xml(order_data: dict, config: dict, nomenclature_data: list,
+                       matched_products: list | None = None) -> str:
+    """
+    Формирует XML-файл заказа, предварительно находя каждую позицию в номенклатуре.
+    Если позиции уже сопоставлены (matched_products из match_order_products), поиск не повторяется.
+    Если файл для 1С записать не удалось, выбрасывает OrderSaveError; ошибка архива только логируется.
+    """
+    if matched_products is None:
+        matched_products = match_order_products(order_data, nomenclature_data)
+
+    xml_parts = list(iter_order_xml(order_data, matched_products))
+    xml = "".join(xml_parts)
+    logging.info(f"Сформирован XML заказа: {len(matched_products)} позиций, {len(xml)} символов.")
+    logging.debug("Сформированный XML заказа:\n%s", xml)
+
+    order_folder = config.get("ORDER_XML_FOLDER", r"C:\1s\docs")
+    if not ensure_folder(order_folder):
+        raise OrderSaveError(f"Папка заказов недоступна: {order_folder}")
+
+    # Один просмотр папки вместо нескольких os.listdir
+    existing = cleanup_docs_folder_if_markers_exist(order_folder)
+    filename = "zakaz.xml" if "zakaz.xml" not in existing else next_order_filename(config, existing)
+    if save_order_xml(xml_parts, order_folder, filename, order_spool_folder(config, order_folder)) is None:
+        raise OrderSaveError(f"Не удалось записать {filename} в {order_folder}")
+
+    # Заказ уже передан в 1С: сбой архива не должен приводить к повторной записи заказа
     archive_folder = config["ARCHIVE_FOLDER"]
-    if not os.path.exists(archive_folder):
-        try:
-            os.makedirs(archive_folder)
-        except Exception as e:
-            logging.error(f"Ошибка создания архива: {e}")
-    if is_duplicate_order(xml, archive_folder):
+    if not ensure_folder(archive_folder):
+        logging.error(f"Ошибка создания архива: {archive_folder}")
+    elif is_duplicate_order(xml, config):
         logging.warning("Дублирование заказа обнаружено – заказ не сохраняется повторно в архив.")
     else:
         today_date = datetime.now().strftime("%d.%m")
         date_filename = f"заказ{today_date}.xml"
-        save_order_xml(xml, folder=archive_folder, base_filename=date_filename, overwrite=True)
+        if save_order_xml(xml_parts, archive_folder, date_filename,
+                          order_spool_folder(config, archive_folder)) is None:
+            logging.error(f"Заказ не сохранён в архив: {archive_folder}")
+        else:
+            remember_archived_order(xml, config)
     return xml
 
 
-def cleanup_docs_folder_if_markers_exist(folder):
-    marker_found = False
-    for filename in os.listdir(folder):
-        if ".processed." in filename:
-            marker_found = True
-            break
-    if marker_found:
-        for filename in os.listdir(folder):
-            if filename.endswith(".xml"):
-                file_path = os.path.join(folder, filename)
-                try:
-                    os.remove(file_path)
-                    logging.info(f"Удалён файл: {file_path}")
-                except Exception as e:
-                    logging.error(f"Ошибка удаления файла {file_path}: {e}")
+def cleanup_docs_folder_if_markers_exist(folder) -> set:
+    """
+    Если в папке есть помеченные 1С файлы (*.processed.*), удаляет из неё все .xml.
+    Возвращает имена файлов, оставшихся в папке.
+    """
+    filenames = set(os.listdir(folder))
+    if any(".processed." in filename for filename in filenames):
+        for filename in [name for name in filenames if name.endswith(".xml")]:
+            file_path = os.path.join(folder, filename)
+            try:
+                os.remove(file_path)
+                filenames.discard(filename)
+                logging.info(f"Удалён файл: {file_path}")
+            except Exception as e:
+                logging.error(f"Ошибка удаления файла {file_path}: {e}")
         logging.info("Папка очищена от обработанных (помеченных) файлов.")
+    return filenames
 
 def extract_phone_number(phone_str: str) -> str:
     matches = re.findall(r'(\+?\d[\d\-\(\)\s]{5,}\d)', phone_str)
@@ -678,189 +937,1678 @@ def extract_phone_number(phone_str: str) -> str:
     return phone_str.strip()
 
 # =============================
-# Функции для обработки писем (IMAP)
+# Дисковый кэш (content-addressed, LRU по времени доступа)
 # =============================
-def get_email_text_with_attachments(config: dict) -> tuple:
+CACHE_STATS = {}
+_cache_sizes = {}
+
+
+def _cache_path(folder: str, key: str) -> str:
+    return os.path.join(folder, key[:2], f"{key}.json")
+
+
+def _cache_stats(name: str) -> dict:
+    return CACHE_STATS.setdefault(name, {"hits": 0, "misses": 0, "evictions": 0})
+
+
+def cache_hit_rate(name: str) -> float:
+    stats = _cache_stats(name)
+    total = stats["hits"] + stats["misses"]
+    return stats["hits"] / total if total else 0.0
+
+
+def disk_cache_get(folder: str, key: str, name: str, ttl: float | None = None) -> dict | None:
     """
-    Финальная версия: корректно читает и тело письма, и вложения.
+    Возвращает запись кэша или None. При попадании обновляет mtime файла,
+    по нему работает вытеснение давно не использованных записей.
+    ttl отсчитывается от created_at - момента записи, а не последнего обращения.
     """
-    logging.info("Подключаюсь к IMAP для получения последнего письма...")
+    path = _cache_path(folder, key)
+    stats = _cache_stats(name)
     try:
-        mail = imaplib.IMAP4_SSL(config["IMAP_SERVER"])
-        mail.login(config["MAIL_USER"], config["MAIL_PASSWORD"])
-        mail.select("INBOX")
-        _, data = mail.search(None, "ALL")
-        mail_ids = data[0].split()
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        # Записи, сохранённые до появления created_at, считаем созданными в момент mtime
+        created_at = entry.get("created_at") or os.path.getmtime(path)
+        if ttl is not None and time.time() - created_at > ttl:
+            os.remove(path)
+            stats["misses"] += 1
+            return None
+        os.utime(path)
+    except (OSError, ValueError, AttributeError):
+        stats["misses"] += 1
+        return None
+    stats["hits"] += 1
+    return entry
 
-        if not mail_ids:
-            mail.logout()
-            logging.info("Почтовый ящик пуст.")
-            return "", None
 
-        latest_id = mail_ids[-1]
-        _, msg_data = mail.fetch(latest_id, '(RFC822)')
-        mail.logout()
-    except Exception as e:
-        logging.error(f"Ошибка подключения или чтения почты: {e}", exc_info=True)
-        return "", None
+def disk_cache_put(folder: str, key: str, entry: dict, name: str, max_bytes: int):
+    """
+    Атомарно сохраняет запись в кэш и при превышении max_bytes вытесняет самые старые записи.
+    К записи добавляется created_at, по нему disk_cache_get проверяет ttl.
+    """
+    path = _cache_path(folder, key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(dict(entry, created_at=time.time()), ensure_ascii=False).encode("utf-8")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f"Не удалось записать кэш {name}: {e}")
+        return
+
+    if folder not in _cache_sizes:
+        _cache_sizes[folder] = sum(size for _, _, size in _scan_cache(folder))
+    else:
+        _cache_sizes[folder] += len(data)
+    if _cache_sizes[folder] > max_bytes:
+        _evict_cache(folder, name, max_bytes)
 
-    raw_email = msg_data[0][1]
-    msg = email.message_from_bytes(raw_email)
 
-    main_text_plain = ""
-    main_text_html = ""
-    attachments_text = ""
+def _scan_cache(folder: str) -> list:
+    entries = []
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            if not filename.endswith(".json"):
+                continue
+            file_path = os.path.join(root, filename)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, file_path, st.st_size))
+    return entries
 
-    for part in msg.walk():
-        # Пропускаем только контейнеры, остальное обрабатываем по логике ниже
-        if part.get_content_type() == "multipart/alternative":
-            continue
 
-        filename = part.get_filename()
+def _evict_cache(folder: str, name: str, max_bytes: int):
+    """Удаляет давно не использованные записи, пока кэш не станет меньше 90% лимита."""
+    entries = sorted(_scan_cache(folder))
+    total = sum(size for _, _, size in entries)
+    target = max_bytes * 0.9
+    for _, file_path, size in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(file_path)
+            total -= size
+            _cache_stats(name)["evictions"] += 1
+        except OSError:
+            pass
+    _cache_sizes[folder] = total
+    logging.info(f"Кэш {name}: вытеснение завершено, размер {total / 1024 / 1024:.1f} МБ")
 
-        # --- 1. ОБРАБОТКА ВЛОЖЕНИЙ ---
-        if filename:
-            try:
-                decoded_filename, enc = decode_header(filename)[0]
-                if isinstance(decoded_filename, bytes):
-                    decoded_filename = decoded_filename.decode(enc or "utf-8", errors="ignore")
 
-                payload = part.get_payload(decode=True)
-                if not payload:
-                    logging.warning(f"Вложение {decoded_filename} не имеет данных (пустое).")
-                    continue
+# =============================
+# Извлечение текста из вложений (пулы воркеров)
+# =============================
+# Экстракторы регистрируются по расширению и MIME-типу. Экстрактор - генератор кусков текста
+# (payload, products); нужные ему тяжёлые библиотеки подгружаются при первом вызове (LazyModule).
+ATTACHMENT_EXTRACTORS = {}  # расширение -> экстрактор
+ATTACHMENT_MIME_TYPES = {}  # MIME-тип -> экстрактор
 
-                attachments_text += f"\n\n--- СОДЕРЖИМОЕ ВЛОЖЕНИЯ: {decoded_filename} ---\n"
-                lower_filename = decoded_filename.lower()
+_attachment_process_pool = None
+_attachment_thread_pool = None
+_attachment_pool_lock = threading.RLock()  # письма разбираются параллельно (PIPELINE_EXTRACT_WORKERS)
 
-                if lower_filename.endswith((".txt", ".csv")):
-                    attachments_text += payload.decode("utf-8-sig", errors="ignore")
 
-                elif lower_filename.endswith(".pdf"):
-                    pdf_text = "".join(page.extract_text() or "" for page in PdfReader(io.BytesIO(payload)).pages)
-                    attachments_text += pdf_text
+def register_extractor(name: str, extensions: tuple, mime_types: tuple = (), version: int = 1,
+                       priority: int = 0, process_pool: bool = False, tables: bool = False):
+    """
+    Регистрирует экстрактор вложений.
+    version входит в ключ кэша: при изменении логики разбора формата увеличьте её.
+    priority - порядок постановки в очередь: дешёвые форматы первыми, OCR последним.
+    process_pool - формат нагружает CPU (PDF, OCR) и разбирается в пуле процессов, а не потоков.
+    tables - экстрактор отдаёт товары из таблиц; такие вложения разбираются целиком
+    независимо от лимита текста, потому что товары в текст письма не попадают.
+    """
+    def decorator(func):
+        extractor = {"name": name, "func": func, "extensions": extensions, "version": version,
+                     "priority": priority, "process_pool": process_pool, "tables": tables}
+        for extension in extensions:
+            ATTACHMENT_EXTRACTORS[extension] = extractor
+        for mime_type in mime_types:
+            ATTACHMENT_MIME_TYPES[mime_type] = extractor
+        return func
+    return decorator
 
-                elif lower_filename.endswith(".docx"):
-                    attachments_text += docx2txt.process(io.BytesIO(payload))
 
-                elif lower_filename.endswith(".xlsx"):
-                    workbook = openpyxl.load_workbook(io.BytesIO(payload), data_only=True)
-                    for sheet in workbook.worksheets:
-                        attachments_text += f"\nЛист: {sheet.title}\n"
-                        for row in sheet.iter_rows(values_only=True):
-                            attachments_text += "\t".join(
-                                [str(cell) if cell is not None else "" for cell in row]) + "\n"
+def find_extractor(filename: str, mime_type: str | None = None) -> dict | None:
+    """Экстрактор по расширению файла, а если расширение неизвестно - по MIME-типу."""
+    extractor = ATTACHMENT_EXTRACTORS.get(os.path.splitext(filename.lower())[1])
+    if extractor is None and mime_type:
+        extractor = ATTACHMENT_MIME_TYPES.get(mime_type.lower())
+    return extractor
 
-                elif lower_filename.endswith((".png", ".jpg", "jpeg")):
-                    ocr_text = pytesseract.image_to_string(Image.open(io.BytesIO(payload)), lang='rus+eng')
-                    attachments_text += f"[Распознанный текст с изображения]:\n{ocr_text}"
 
-                else:
-                    attachments_text += f"[Формат файла '{decoded_filename}' не поддерживается для чтения]"
-                    logging.warning(f"Вложение '{decoded_filename}' имеет неподдерживаемый тип.")
+def uses_process_pool(decoded_filename: str) -> bool:
+    extractor = find_extractor(decoded_filename)
+    return bool(extractor and extractor["process_pool"])
 
-            except Exception as e:
-                logging.error(f"Не удалось прочитать вложение {decoded_filename}: {e}", exc_info=True)
-                attachments_text += f"[ОШИБКА ЧТЕНИЯ ФАЙЛА {decoded_filename}]"
 
-        # --- 2. ОБРАБОТКА ТЕЛА ПИСЬМА ---
-        content_type = part.get_content_type()
-        if not filename and content_type.startswith("text/"):
-            charset = part.get_content_charset() or "utf-8"
-            payload = part.get_payload(decode=True)
-            if not payload:
-                continue
+def extracts_tables(decoded_filename: str) -> bool:
+    extractor = find_extractor(decoded_filename)
+    return bool(extractor and extractor["tables"])
 
-            try:
-                body_part_text = payload.decode(charset, errors="ignore")
-                if content_type == "text/plain":
-                    main_text_plain += body_part_text + "\n"
-                elif content_type == "text/html":
-                    main_text_html += body_part_text + "\n"
-            except Exception as e:
-                logging.error(f"Ошибка декодирования тела письма (тип: {content_type}): {e}")
 
-    # Выбираем, какой текст использовать: plain-text в приоритете
-    final_main_text = main_text_plain.strip()
-    if not final_main_text and main_text_html:
-        logging.info("Plain-text версия не найдена, используется HTML-версия.")
-        soup = BeautifulSoup(main_text_html, "html.parser")
-        final_main_text = soup.get_text(separator="\n", strip=True)
+@register_extractor("txt", (".txt", ".csv"), ("text/plain", "text/csv"), version=1, priority=0)
+def _extract_plain_text(payload: bytes, products: list | None = None):
+    yield payload.decode("utf-8-sig", errors="ignore")
 
-    # --- 3. ФОРМИРОВАНИЕ ИТОГОВОГО ТЕКСТА ---
-    combined_text = f"=== ТЕКСТ ПИСЬМА ===\n{final_main_text}\n\n=== ВЛОЖЕНИЯ ===\n{attachments_text.strip()}"
 
-    max_length = 10000  # Можно настроить
-    if len(combined_text) > max_length:
-        combined_text = combined_text[:max_length] + "\n...[текст обрезан из-за превышения лимита]"
+@register_extractor("docx", (".docx",),
+                    ("application/vnd.openxmlformats-officedocument.wordprocessingml.document",),
+                    version=1, priority=1)
+def _extract_docx(payload: bytes, products: list | None = None):
+    yield docx2txt.process(io.BytesIO(payload))
 
-    return combined_text, msg
 
+@register_extractor("pdf", (".pdf",), ("application/pdf",), version=2, priority=3, process_pool=True)
+def _extract_pdf(payload: bytes, products: list | None = None):
+    yield from iter_pdf_text(payload)
 
-# =============================
-# Функции для извлечения товаров из письма (fallback, regex, GPT)
-# =============================
-def fallback_extract_products_new(email_text: str) -> list:
-    products = []
-    start = email_text.find("Номенклатура")
-    if start == -1:
-        return products
-    block = email_text[start:]
-    signature_markers = ["С уважением", "С уважением,"]
-    for marker in signature_markers:
-        idx = block.find(marker)
-        if idx != -1:
-            block = block[:idx]
-            break
-    lines = [line.strip() for line in block.splitlines() if line.strip()]
-    headers = {"Номенклатура", "Ед.изм.", "Кол-во по спец."}
-    while lines and lines[0] in headers:
-        lines.pop(0)
-    if not lines:
-        return products
-    if len(lines) % 3 != 0:
-        logging.warning("Количество строк в блоке номенклатуры не кратно 3, обработка может быть неполной.")
-    i = 0
-    while i < len(lines) - 2:
-        name = lines[i]
-        quantity_str = lines[i + 2]
-        try:
-            quantity = int(quantity_str)
-        except ValueError:
-            try:
-                quantity = float(quantity_str)
-            except ValueError:
-                quantity = 1
-        products.append({
-            "name": name,
-            "code": "",
-            "quantity": quantity,
-            "sum": 0.0
-        })
-        i += 3
-    return products
 
-def regex_extract_products(email_text: str) -> list:
-    products = []
-    pattern = re.compile(r'^(?P<name>.+?)\s+(?P<quantity>\d+)\s*$', re.MULTILINE)
-    for m in pattern.finditer(email_text):
-        name = m.group("name").strip()
-        try:
-            quantity = int(m.group("quantity"))
-        except ValueError:
-            quantity = 1
-        products.append({
-            "name": name,
-            "code": "",
-            "quantity": quantity,
-            "sum": 0.0
-        })
-    return products
+@register_extractor("png", (".png", ".jpg", ".jpeg"), ("image/png", "image/jpeg"), version=2, priority=4,
+                    process_pool=True)
+def _extract_image(payload: bytes, products: list | None = None):
+    yield "[Распознанный текст с изображения]:\n"
+    yield ocr_image_bytes(payload)
 
 
-def gpt_extract_products(email_text: str) -> list:
-    headers = {
-        "Authorization": f"Api-Key {config['YANDEX_SA_API_KEY']}",
+def iter_attachment_text(decoded_filename: str, payload: bytes, products: list | None = None):
+    """
+    Лениво отдаёт текст вложения кусками (страница PDF, строка листа, страница OCR),
+    чтобы вызывающий мог остановиться, как только исчерпан лимит символов.
+    Если передан список products, листы-таблицы с распознанной шапкой не превращаются в текст,
+    а их строки сразу добавляются в products.
+    """
+    extractor = find_extractor(decoded_filename)
+    if extractor is None:
+        logging.warning(f"Вложение '{decoded_filename}' имеет неподдерживаемый тип.")
+        yield f"[Формат файла '{decoded_filename}' не поддерживается для чтения]"
+        return
+    yield from extractor["func"](payload, products)
+
+
+def iter_pdf_text(payload: bytes):
+    """
+    Постранично отдаёт текст PDF. Страницы с текстовым слоем берутся как есть,
+    страницы без него (сканы) распознаются OCR по встроенным изображениям
+    в пуле из OCR_WORKERS потоков с сохранением порядка страниц.
+    Вперёд читается не больше страниц, чем OCR-задач помещается в пул.
+    """
+    reader = PyPDF2.PdfReader(io.BytesIO(payload))
+    workers = config.get("OCR_WORKERS", 2)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr")
+    queue = deque()
+    in_flight = 0
+    try:
+        for page in reader.pages:
+            page_text = page.extract_text() or ""
+            if page_text.strip():
+                queue.append(page_text)
+            else:
+                # Чтение объектов PDF не потокобезопасно, поэтому картинки достаём здесь, а в пул отдаём байты
+                try:
+                    images = [image.data for image in page.images]
+                except Exception as e:
+                    logging.warning(f"Не удалось извлечь изображения страницы PDF: {e}")
+                    images = []
+                if images:
+                    queue.append(pool.submit(ocr_page_images, images))
+                    in_flight += 1
+                else:
+                    queue.append(page_text)
+
+            while queue and (isinstance(queue[0], str) or in_flight >= workers):
+                item = queue.popleft()
+                if isinstance(item, str):
+                    yield item
+                else:
+                    in_flight -= 1
+                    yield item.result()
+
+        while queue:
+            item = queue.popleft()
+            yield item if isinstance(item, str) else item.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def ocr_page_images(images: list) -> str:
+    """
+    Распознаёт все изображения одной страницы скана.
+    Битое изображение или таймаут tesseract не должны ронять весь PDF - такое изображение пропускается.
+    """
+    texts = []
+    for data in images:
+        try:
+            texts.append(ocr_image_bytes(data))
+        except Exception as e:
+            logging.warning(f"Не удалось распознать изображение страницы PDF: {e}")
+            texts.append("")
+    return "\n".join(texts)
+
+
+def preprocess_image_for_ocr(image: "Image.Image") -> "Image.Image":
+    """
+    Готовит изображение к OCR: уменьшает слишком большие картинки до OCR_MAX_SIDE,
+    переводит в оттенки серого и бинаризует по порогу Оцу.
+    """
+    max_side = config.get("OCR_MAX_SIDE", 3000)
+    if max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    gray = ImageOps.exif_transpose(image).convert("L")
+
+    histogram = gray.histogram()
+    total = sum(histogram)
+    sum_all = sum(i * count for i, count in enumerate(histogram))
+    sum_background = 0
+    weight_background = 0
+    best_threshold, best_variance = 127, 0.0
+    for threshold, count in enumerate(histogram):
+        weight_background += count
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+        sum_background += threshold * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = threshold, variance
+
+    return gray.point(lambda p: 255 if p > best_threshold else 0)
+
+
+def ocr_image_bytes(data: bytes) -> str:
+    image = preprocess_image_for_ocr(Image.open(io.BytesIO(data)))
+    return pytesseract.image_to_string(image, lang=config.get("OCR_LANG", "rus+eng"),
+                                       timeout=config.get("OCR_PAGE_TIMEOUT", 0))
+
+
+@register_extractor("xlsx", (".xlsx",),
+                    ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",),
+                    version=3, priority=2, tables=True)
+def iter_xlsx_text(payload: bytes, products: list | None = None):
+    """
+    Потоковое чтение .xlsx в режиме read_only: строки не держатся в памяти целиком.
+    Лист, в первых строках которого найдена шапка (наименование / кол-во / ед.изм.),
+    при переданном products разбирается сразу в товары, минуя текст.
+    Строки таблицы, которые не удалось разобрать в товар, остаются в тексте вместе с шапкой.
+    """
+    workbook = openpyxl.load_workbook(io.BytesIO(payload), read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield f"\nЛист: {sheet.title}\n"
+            columns = None
+            header_cells = None
+            header_yielded = False
+            head_rows = []
+            sheet_products = []
+            scanning = products is not None
+            for row in sheet.iter_rows(values_only=True):
+                cells = [str(cell) if cell is not None else "" for cell in row]
+                if columns is not None:
+                    product = table_row_to_product(cells, columns)
+                    if product:
+                        sheet_products.append(product)
+                    elif not table_row_is_skipped(cells, columns):
+                        if not header_yielded:
+                            yield "\t".join(header_cells) + "\n"
+                            header_yielded = True
+                        yield "\t".join(cells) + "\n"
+                    continue
+                if scanning:
+                    columns = detect_product_columns(cells)
+                    if columns is not None:
+                        header_cells = cells
+                        for head_cells in head_rows:
+                            yield "\t".join(head_cells) + "\n"
+                        head_rows = []
+                        continue
+                    head_rows.append(cells)
+                    if len(head_rows) < TABLE_HEADER_SCAN_ROWS:
+                        continue
+                    # Шапки в первых строках нет - дальше лист идёт обычным текстом
+                    scanning = False
+                    for head_cells in head_rows:
+                        yield "\t".join(head_cells) + "\n"
+                    head_rows = []
+                    continue
+                yield "\t".join(cells) + "\n"
+
+            for head_cells in head_rows:
+                yield "\t".join(head_cells) + "\n"
+            if columns is not None and sheet_products:
+                products.extend(sheet_products)
+                logging.info(f"Лист '{sheet.title}': распознана таблица товаров, позиций: {len(sheet_products)}")
+                yield f"[Таблица товаров: {len(sheet_products)} позиций передано напрямую]\n"
+            elif columns is not None and not header_yielded:
+                # Ни одной позиции не разобрано - шапка остаётся в тексте, как и весь лист
+                yield "\t".join(header_cells) + "\n"
+    finally:
+        workbook.close()
+
+
+def extract_attachment_text(decoded_filename: str, payload: bytes, char_limit: int | None = None) -> tuple:
+    """
+    Извлекает текст из одного вложения. Возвращает (текст, complete, товары из таблиц).
+    При char_limit разбор прекращается, как только текст без хвостовых пробелов длиннее лимита,
+    тогда complete=False, а текст - точный префикс полного текста вложения.
+    Выполняется в воркере пула, поэтому должна оставаться функцией верхнего уровня.
+    """
+    chunks = []
+    products = []
+    length = 0
+    for chunk in iter_attachment_text(decoded_filename, payload, products):
+        chunks.append(chunk)
+        length += len(chunk)
+        if char_limit is not None and length > char_limit:
+            text = "".join(chunks)
+            if len(text.rstrip()) > char_limit:
+                return text, False, products
+    return "".join(chunks), True, products
+
+
+def _extractor_priority(decoded_filename: str) -> int:
+    extractor = find_extractor(decoded_filename)
+    return extractor["priority"] if extractor else 0
+
+
+def attachment_cache_key(decoded_filename: str, payload: bytes) -> str | None:
+    """Ключ кэша: SHA-256 содержимого вложения + версия экстрактора. None - формат не кэшируется."""
+    extractor = find_extractor(decoded_filename)
+    if extractor is None:
+        return None
+    return f"{hashlib.sha256(payload).hexdigest()}_{extractor['name']}_v{extractor['version']}"
+
+
+def _limit_worker_memory(memory_limit_mb: int):
+    """
+    Инициализатор процесса-воркера: ограничивает объём памяти процесса.
+    На Linux - через resource.setrlimit, на Windows - через Job Object (pywin32).
+    """
+    if not memory_limit_mb:
+        return
+    limit_bytes = int(memory_limit_mb) * 1024 * 1024
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+        return
+    except ImportError:
+        pass
+    except (ValueError, OSError) as e:
+        logging.warning(f"Не удалось ограничить память воркера: {e}")
+        return
+
+    try:
+        import win32api
+        import win32job
+        job = win32job.CreateJobObject(None, "")
+        info = win32job.QueryInformationJobObject(job, win32job.JobObjectExtendedLimitInformation)
+        info["ProcessMemoryLimit"] = limit_bytes
+        info["BasicLimitInformation"]["LimitFlags"] |= win32job.JOB_OBJECT_LIMIT_PROCESS_MEMORY
+        win32job.SetInformationJobObject(job, win32job.JobObjectExtendedLimitInformation, info)
+        win32job.AssignProcessToJobObject(job, win32api.GetCurrentProcess())
+    except Exception as e:
+        logging.warning(f"Ограничение памяти воркера недоступно: {e}")
+
+
+def _init_attachment_worker(memory_limit_mb: int, worker_config: dict):
+    """
+    Инициализатор процесса-воркера. Воркеры запускаются через forkserver или spawn: модуль импортируется
+    заново без init, поэтому конфиг передаётся из родительского процесса.
+    """
+    if not config:
+        config.update(worker_config)
+        logging.basicConfig(level=log_level, format=log_format)
+    _limit_worker_memory(memory_limit_mb)
+
+
+def _attachment_mp_context():
+    """
+    Способ запуска воркеров вложений. Пул создаётся лениво, когда в процессе уже работают
+    потоки (конвейер, пул потоков вложений, GPT): fork копирует их блокировки в захваченном
+    состоянии, и воркер может зависнуть навсегда. Поэтому forkserver, а где его нет - spawn.
+    """
+    start_methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in start_methods else "spawn")
+
+
+def _get_attachment_pool(decoded_filename: str, config: dict):
+    """Возвращает (лениво создавая) пул, подходящий для типа вложения."""
+    global _attachment_process_pool, _attachment_thread_pool
+
+    with _attachment_pool_lock:
+        if uses_process_pool(decoded_filename):
+            if _attachment_process_pool is None:
+                _attachment_process_pool = ProcessPoolExecutor(
+                    max_workers=config.get("ATTACHMENT_PROCESS_WORKERS", os.cpu_count() or 2),
+                    initializer=_init_attachment_worker,
+                    initargs=(config.get("ATTACHMENT_MEMORY_LIMIT_MB", 1024), dict(config)),
+                    mp_context=_attachment_mp_context(),
+                )
+            return _attachment_process_pool
+
+        if _attachment_thread_pool is None:
+            _attachment_thread_pool = ThreadPoolExecutor(
+                max_workers=config.get("ATTACHMENT_THREAD_WORKERS", 4),
+                thread_name_prefix="attachment",
+            )
+        return _attachment_thread_pool
+
+
+def _reset_attachment_process_pool(pool):
+    """
+    Останавливает пул процессов вместе с зависшими воркерами.
+    Новый пул будет создан при следующем вложении. Если pool уже заменён другим письмом,
+    ничего не делает: новый пул не трогаем.
+    Задачи других писем в остановленном пуле завершатся с BrokenExecutor/CancelledError,
+    и extract_attachments_text поставит их заново.
+    """
+    global _attachment_process_pool
+    with _attachment_pool_lock:
+        if pool is None or _attachment_process_pool is not pool:
+            return
+        _attachment_process_pool = None
+    terminate_workers = getattr(pool, "terminate_workers", None)  # Python 3.14+
+    if terminate_workers:
+        terminate_workers()
+        return
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _reset_attachment_thread_pool(pool):
+    """
+    Заменяет пул потоков, в котором завис поток: прервать его нельзя, а занятый слот
+    не дал бы стартовать новым задачам. Остальные задачи старого пула дорабатывают в нём.
+    """
+    global _attachment_thread_pool
+    with _attachment_pool_lock:
+        if pool is None or _attachment_thread_pool is not pool:
+            return
+        _attachment_thread_pool = None
+    pool.shutdown(wait=False)
+
+
+def _job_char_limit(decoded_filename: str, char_budget: int | None) -> int | None:
+    # Вложения с таблицами товаров разбираются целиком: лимит касается только текста
+    return None if extracts_tables(decoded_filename) else char_budget
+
+
+def extract_attachments_text(attachment_jobs: list, config: dict, char_budget: int | None = None) -> tuple:
+    """
+    Параллельно извлекает текст всех вложений письма и собирает его в исходном порядке.
+    Возвращает (текст вложений, товары из распознанных таблиц).
+    attachment_jobs - список (имя файла, payload); payload=None означает, что вложение не удалось прочитать.
+    char_budget - сколько символов вложений (после strip) ещё поместится в итоговый текст письма:
+    экстракторы останавливаются на лимите, а вложения после его исчерпания не разбираются вовсе.
+    Исключение - вложения с таблицами товаров (extracts_tables): они разбираются целиком всегда,
+    и товары из них собираются даже после исчерпания лимита текста.
+    Каждая задача ограничена по времени ATTACHMENT_TIMEOUT секунд с момента фактического старта,
+    а все вложения письма - ATTACHMENT_EMAIL_TIMEOUT секундами с момента постановки в очередь
+    (задача может так и не стартовать, если пул занят зависшими задачами).
+    Задачи, потерянные из-за перезапуска пула процессов другим письмом, ставятся заново
+    (не больше ATTACHMENT_POOL_RETRIES раз).
+    """
+    timeout = config.get("ATTACHMENT_TIMEOUT", 120)
+    email_timeout = config.get("ATTACHMENT_EMAIL_TIMEOUT", 3 * timeout)
+    pool_retries = config.get("ATTACHMENT_POOL_RETRIES", 2)
+    cache_folder = config.get("ATTACHMENT_CACHE_FOLDER", "attachment_cache")
+    cache_max_bytes = config.get("ATTACHMENT_CACHE_MAX_MB", 512) * 1024 * 1024
+    futures = {}
+    future_pools = {}
+    resubmits = {}
+    results = {}
+    table_products = {}
+    cache_keys = {}
+
+    def submit(index):
+        decoded_filename, payload = attachment_jobs[index]
+        # Под блокировкой: пул не может быть остановлен между получением и постановкой задачи
+        with _attachment_pool_lock:
+            pool = _get_attachment_pool(decoded_filename, config)
+            future = pool.submit(extract_attachment_text, decoded_filename, payload,
+                                 _job_char_limit(decoded_filename, char_budget))
+        futures[future] = index
+        future_pools[future] = pool
+        return future
+
+    job_order = sorted(range(len(attachment_jobs)), key=lambda i: _extractor_priority(attachment_jobs[i][0]))
+    for index in job_order:
+        decoded_filename, payload = attachment_jobs[index]
+        if payload is None:
+            results[index] = f"[ОШИБКА ЧТЕНИЯ ФАЙЛА {decoded_filename}]"
+            continue
+        if cache_folder:
+            cache_key = attachment_cache_key(decoded_filename, payload)
+            if cache_key:
+                cached = disk_cache_get(cache_folder, cache_key, "attachments")
+                if cached is not None and (cached.get("complete", True) or (
+                        char_budget is not None and len(cached["text"].rstrip()) > char_budget
+                        and not extracts_tables(decoded_filename))):
+                    logging.info(f"Текст вложения {decoded_filename} взят из кэша.")
+                    results[index] = cached["text"]
+                    table_products[index] = cached.get("products", [])
+                    continue
+                cache_keys[index] = cache_key
+        try:
+            submit(index)
+        except Exception as e:
+            logging.error(f"Не удалось поставить вложение {decoded_filename} в очередь: {e}", exc_info=True)
+            results[index] = f"[ОШИБКА ЧТЕНИЯ ФАЙЛА {decoded_filename}]"
+
+    attachments_text = ""
+    products = []
+    assembled = 0
+    budget_reached = False
+    skipped = 0
+    pending = set(futures)
+    started_at = {}
+    deadline = time.monotonic() + email_timeout
+    while True:
+        # Собираем готовые вложения строго по порядку и проверяем лимит
+        while assembled < len(attachment_jobs) and assembled in results:
+            if not budget_reached:
+                attachments_text += f"\n\n--- СОДЕРЖИМОЕ ВЛОЖЕНИЯ: {attachment_jobs[assembled][0]} ---\n"
+                attachments_text += results[assembled]
+                if char_budget is not None and len(attachments_text.strip()) > char_budget:
+                    budget_reached = True
+                    # Текст дальше не нужен: ждём только вложения, из которых берутся товары
+                    for future in [f for f in pending if not extracts_tables(attachment_jobs[futures[f]][0])]:
+                        future.cancel()
+                        pending.discard(future)
+                        results[futures[future]] = ""
+                        skipped += 1
+            products.extend(table_products.get(assembled, []))
+            assembled += 1
+        if not pending:
+            break
+
+        done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = futures[future]
+            decoded_filename = attachment_jobs[index][0]
+            try:
+                text, complete, sheet_products = future.result()
+                results[index] = text
+                table_products[index] = sheet_products
+                if index in cache_keys:
+                    disk_cache_put(cache_folder, cache_keys[index],
+                                   {"text": text, "complete": complete, "products": sheet_products},
+                                   "attachments", cache_max_bytes)
+            except (BrokenExecutor, CancelledError) as e:
+                # Пул остановлен (зависшая задача другого письма или упавший воркер) - пробуем ещё раз
+                if uses_process_pool(decoded_filename) and resubmits.get(index, 0) < pool_retries:
+                    resubmits[index] = resubmits.get(index, 0) + 1
+                    logging.warning(f"Пул процессов остановлен, вложение {decoded_filename} поставлено заново.")
+                    try:
+                        pending.add(submit(index))
+                        continue
+                    except Exception as submit_error:
+                        e = submit_error
+                logging.error(f"Не удалось прочитать вложение {decoded_filename}: {e}", exc_info=True)
+                results[index] = f"[ОШИБКА ЧТЕНИЯ ФАЙЛА {decoded_filename}]"
+            except Exception as e:
+                logging.error(f"Не удалось прочитать вложение {decoded_filename}: {e}", exc_info=True)
+                results[index] = f"[ОШИБКА ЧТЕНИЯ ФАЙЛА {decoded_filename}]"
+
+        now = time.monotonic()
+        timed_out = []
+        for future in pending:
+            if future.running():
+                started_at.setdefault(future, now)
+            if (future in started_at and now - started_at[future] > timeout) or now > deadline:
+                timed_out.append(future)
+
+        reset_pools = set()
+        stale_thread_pools = set()
+        for future in timed_out:
+            pending.discard(future)
+            future.cancel()
+            decoded_filename = attachment_jobs[futures[future]][0]
+            if future in started_at and now - started_at[future] > timeout:
+                logging.error(f"Превышено время обработки вложения {decoded_filename} ({timeout} с).")
+            else:
+                logging.error(f"Превышено время обработки вложений письма ({email_timeout} с), "
+                              f"вложение {decoded_filename} не разобрано.")
+            results[futures[future]] = f"[ПРЕВЫШЕНО ВРЕМЯ ЧТЕНИЯ ФАЙЛА {decoded_filename}]"
+            if future not in started_at:
+                continue
+            # Зависшая задача держит слот пула: процесс убиваем вместе с пулом, пул потоков заменяем
+            if uses_process_pool(decoded_filename):
+                reset_pools.add(future_pools[future])
+            else:
+                stale_thread_pools.add(future_pools[future])
+
+        for pool in stale_thread_pools:
+            _reset_attachment_thread_pool(pool)
+
+        for pool in reset_pools:
+            # Остальные задачи убитого пула не виноваты - перезапускаем их в новом пуле
+            survivors = [f for f in pending if future_pools[f] is pool]
+            _reset_attachment_process_pool(pool)
+            for future in survivors:
+                pending.discard(future)
+                started_at.pop(future, None)
+                index = futures.pop(future)
+                try:
+                    pending.add(submit(index))
+                except Exception as e:
+                    decoded_filename = attachment_jobs[index][0]
+                    logging.error(f"Не удалось поставить вложение {decoded_filename} в очередь: {e}", exc_info=True)
+                    results[index] = f"[ОШИБКА ЧТЕНИЯ ФАЙЛА {decoded_filename}]"
+
+    if budget_reached:
+        logging.info(f"Лимит текста письма исчерпан, не разобрано вложений: {skipped}")
+
+    if cache_folder and attachment_jobs:
+        stats = _cache_stats("attachments")
+        logging.info(f"Кэш вложений: попаданий {stats['hits']}, промахов {stats['misses']}, "
+                     f"hit rate {cache_hit_rate('attachments'):.0%}")
+
+    return attachments_text, products
+
+# =============================
+# Архивы во вложениях (zip, tar, gz)
+# =============================
+# Порядок важен: составные расширения проверяются раньше ".gz"
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ARCHIVE_EXTENSIONS = (".zip",) + TAR_EXTENSIONS + (".gz",)
+ARCHIVE_READ_CHUNK = 1024 * 1024
+
+
+class ArchiveLimitExceeded(Exception):
+    """Архив превысил ограничения по числу файлов, объёму или глубине вложенности."""
+
+
+def is_archive_filename(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def _is_supported_member(member_name: str) -> bool:
+    lower_name = member_name.lower()
+    return is_archive_filename(lower_name) or find_extractor(lower_name) is not None
+
+
+def _count_archive_bytes(limits: dict, size: int, member_name: str):
+    limits["bytes"] += size
+    if limits["bytes"] > limits["max_bytes"]:
+        raise ArchiveLimitExceeded(
+            f"превышен допустимый объём распаковки ({limits['max_bytes'] // (1024 * 1024)} МБ) на файле {member_name}")
+
+
+def _read_archive_member(stream, member_name: str, limits: dict) -> bytes:
+    """
+    Распаковывает файл архива кусками, считая реально распакованные байты.
+    Размеру из заголовка архива не доверяем: на нём и строятся zip-бомбы.
+    """
+    chunks = []
+    while True:
+        chunk = stream.read(ARCHIVE_READ_CHUNK)
+        if not chunk:
+            break
+        _count_archive_bytes(limits, len(chunk), member_name)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _iter_archive_members(archive_name: str, payload: bytes):
+    """
+    Отдаёт (имя файла, поток, размер из заголовка) по одному файлу архива, не распаковывая остальные.
+    Заявленный размер нужен для файлов, которые пропускаются без распаковки.
+    """
+    lower_name = archive_name.lower()
+    if lower_name.endswith(".zip"):
+        with zipfile.ZipFile(io.BytesIO(payload)) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                member_name = info.filename
+                if not info.flag_bits & 0x800:
+                    # Без флага UTF-8 имена в zip из Windows обычно в cp866
+                    member_name = member_name.encode("cp437").decode("cp866", errors="replace")
+                if info.flag_bits & 0x1:
+                    yield member_name, None, info.file_size  # зашифрованный файл прочитать нельзя
+                    continue
+                with archive.open(info) as stream:
+                    yield member_name, stream, info.file_size
+
+    elif lower_name.endswith(TAR_EXTENSIONS):
+        with tarfile.open(fileobj=io.BytesIO(payload), mode="r:*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                yield member.name, archive.extractfile(member), member.size
+
+    else:
+        # Одиночный .gz - внутри один файл с именем архива без ".gz";
+        # размер (по модулю 4 ГБ) записан в последних четырёх байтах
+        with gzip.GzipFile(fileobj=io.BytesIO(payload)) as stream:
+            yield os.path.basename(archive_name)[:-len(".gz")], stream, int.from_bytes(payload[-4:], "little")
+
+
+def expand_archive(archive_name: str, payload: bytes, config: dict, depth: int = 0,
+                   limits: dict | None = None) -> list:
+    """
+    Раскладывает архив на список вложений (имя, payload) для обычных экстракторов.
+    Файлы распаковываются по одному и потоково; неподдерживаемые форматы не распаковываются вовсе.
+    Защита от zip-бомб: ARCHIVE_MAX_MEMBERS файлов, ARCHIVE_MAX_TOTAL_MB распакованных данных
+    и ARCHIVE_MAX_DEPTH уровней вложенности на всё письмо-вложение целиком.
+    Пропущенные без распаковки файлы учитываются в объёме по размеру из заголовка архива.
+    """
+    if limits is None:
+        limits = {
+            "members": 0,
+            "bytes": 0,
+            "max_members": config.get("ARCHIVE_MAX_MEMBERS", 200),
+            "max_bytes": config.get("ARCHIVE_MAX_TOTAL_MB", 200) * 1024 * 1024,
+        }
+    max_depth = config.get("ARCHIVE_MAX_DEPTH", 3)
+    jobs = []
+    try:
+        for member_name, stream, declared_size in _iter_archive_members(archive_name, payload):
+            full_name = f"{archive_name}/{member_name}"
+            limits["members"] += 1
+            if limits["members"] > limits["max_members"]:
+                raise ArchiveLimitExceeded(f"больше {limits['max_members']} файлов")
+            if stream is None:
+                logging.warning(f"Файл {full_name} зашифрован и пропущен.")
+                _count_archive_bytes(limits, declared_size, full_name)
+                jobs.append((full_name, None))
+                continue
+            if not _is_supported_member(member_name):
+                # Экстрактору формата payload не нужен - он только сообщит о неподдерживаемом типе
+                _count_archive_bytes(limits, declared_size, full_name)
+                jobs.append((full_name, b""))
+                continue
+
+            member_payload = _read_archive_member(stream, full_name, limits)
+            if is_archive_filename(member_name):
+                if depth + 1 >= max_depth:
+                    raise ArchiveLimitExceeded(f"вложенность архивов глубже {max_depth}")
+                jobs.extend(expand_archive(full_name, member_payload, config, depth + 1, limits))
+            elif member_payload:
+                jobs.append((full_name, member_payload))
+    except ArchiveLimitExceeded as e:
+        logging.error(f"Архив {archive_name} обработан частично: {e}")
+        jobs.append((archive_name, None))
+    except Exception as e:
+        logging.error(f"Не удалось распаковать архив {archive_name}: {e}", exc_info=True)
+        jobs.append((archive_name, None))
+
+    if depth == 0:
+        logging.info(f"Архив {archive_name}: файлов {limits['members']}, распаковано {limits['bytes']} байт.")
+    return jobs
+
+
+# =============================
+# HTML-тело письма: текст и таблицы товаров
+# =============================
+def _table_cells_to_products(rows: list) -> tuple | None:
+    """
+    Ищет шапку таблицы товаров в первых строках и разбирает строки под ней.
+    rows - список строк, каждая - список текстов ячеек.
+    Возвращает (товары, текст на месте таблицы): в тексте - отметка о переданных товарах,
+    строки над шапкой и неразобранные строки с шапкой. None - таблица не товарная
+    или в ней не разобрано ни одной позиции, тогда она остаётся текстом целиком.
+    """
+    for header_index, cells in enumerate(rows[:TABLE_HEADER_SCAN_ROWS]):
+        columns = detect_product_columns(cells)
+        if columns is None:
+            continue
+        products = []
+        unparsed_rows = []
+        for row_cells in rows[header_index + 1:]:
+            product = table_row_to_product(row_cells, columns)
+            if product:
+                products.append(product)
+            elif not table_row_is_skipped(row_cells, columns):
+                unparsed_rows.append(row_cells)
+        if not products:
+            return None
+        text_rows = [row for row in rows[:header_index] if any(row)]
+        if unparsed_rows:
+            text_rows += [cells] + unparsed_rows
+        lines = [f"[Таблица товаров: {len(products)} позиций передано напрямую]"]
+        lines += ["\t".join(row) for row in text_rows]
+        return products, "\n".join(lines)
+    return None
+
+
+def _html_to_text_and_products_lxml(main_text_html: str) -> tuple:
+    document = lxml_html.document_fromstring(main_text_html)
+    # Как и в bs4.get_text: текст script/style отбрасывается, а <title> из <head> остаётся
+    for element in document.xpath("//script|//style"):
+        element.drop_tree()
+
+    products = []
+    # Сначала вложенные таблицы: товарная таблица часто лежит внутри вёрстки из таблиц
+    for table in reversed(document.xpath("//table")):
+        rows = [
+            [" ".join(cell.text_content().split()) for cell in row.xpath("./td|./th")]
+            for row in table.xpath("./tr|./thead/tr|./tbody/tr|./tfoot/tr")
+        ]
+        parsed = _table_cells_to_products(rows)
+        if parsed is None:
+            continue
+        table_products, table_text = parsed
+        products.extend(reversed(table_products))
+        note = lxml_html.Element("p")
+        note.text = table_text
+        table.addprevious(note)
+        table.drop_tree()
+
+    products.reverse()
+    text = "\n".join(chunk.strip() for chunk in document.itertext() if chunk.strip())
+    return text, products
+
+
+def _html_to_text_and_products_bs4(main_text_html: str) -> tuple:
+    soup = bs4.BeautifulSoup(main_text_html, "html.parser")
+    products = []
+    for table in reversed(soup.find_all("table")):
+        rows = [
+            [" ".join(cell.get_text(" ").split()) for cell in row.find_all(["td", "th"], recursive=False)]
+            for row in table.find_all("tr")
+            if row.find_parent("table") is table
+        ]
+        parsed = _table_cells_to_products(rows)
+        if parsed is None:
+            continue
+        table_products, table_text = parsed
+        products.extend(reversed(table_products))
+        table.replace_with(soup.new_string(table_text))
+
+    products.reverse()
+    return soup.get_text(separator="\n", strip=True), products
+
+
+def html_to_text_and_products(main_text_html: str) -> tuple:
+    """
+    Превращает HTML-тело письма в текст. Таблицы с шапкой "наименование / ед.изм. / кол-во"
+    не расплющиваются в текст, а сразу разбираются в товары.
+    Если установлен lxml, используется он (заметно быстрее html.parser на больших письмах).
+    Возвращает (текст, товары).
+    """
+    if LXML_AVAILABLE:
+        try:
+            text, products = _html_to_text_and_products_lxml(main_text_html)
+        except Exception as e:
+            logging.warning(f"lxml не смог разобрать HTML письма, используется html.parser: {e}")
+            text, products = _html_to_text_and_products_bs4(main_text_html)
+    else:
+        text, products = _html_to_text_and_products_bs4(main_text_html)
+    if products:
+        logging.info(f"Из HTML-таблиц письма извлечено позиций: {len(products)}")
+    return text, products
+
+
+# =============================
+# Функции для обработки писем (IMAP)
+# =============================
+def email_text_limit(config: dict) -> int:
+    """
+    Лимит длины текста письма. В режиме GPT_CHUNKING длинные спецификации не обрезаются
+    до лимита одного запроса: товары из них извлекаются по частям.
+    """
+    if config.get("GPT_CHUNKING"):
+        return config.get("GPT_CHUNKING_TEXT_LENGTH", 200000)
+    return config.get("MAX_EMAIL_TEXT_LENGTH", 10000)
+
+
+def cut_email_text(email_text: str, config: dict) -> str:
+    """Обрезает текст до лимита одного запроса к GPT (MAX_EMAIL_TEXT_LENGTH)."""
+    max_length = config.get("MAX_EMAIL_TEXT_LENGTH", 10000)
+    if len(email_text) > max_length:
+        return email_text[:max_length] + "\n...[текст обрезан из-за превышения лимита]"
+    return email_text
+
+
+def _select_inbox(mail) -> int | None:
+    """Открывает INBOX и возвращает его UIDVALIDITY (None, если сервер его не сообщил)."""
+    mail.select("INBOX")
+    _, data = mail.response("UIDVALIDITY")
+    try:
+        return int(data[-1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def fetch_emails_by_uid(config: dict, uids: list, uid_validity: int | None = None) -> list:
+    """
+    Забирает из INBOX письма с указанными UID. Возвращает список (uid, msg) для найденных писем.
+    Если UIDVALIDITY ящика уже не тот, при котором UID были получены, ничего не забирает:
+    под теми же UID теперь другие письма.
+    """
+    mail = imaplib.IMAP4_SSL(config["IMAP_SERVER"])
+    try:
+        mail.login(config["MAIL_USER"], config["MAIL_PASSWORD"])
+        current_validity = _select_inbox(mail)
+        if uid_validity is not None and current_validity != uid_validity:
+            logging.warning(f"UIDVALIDITY ящика изменился ({uid_validity} -> {current_validity}), "
+                            f"письма UID {uids} повторно не забираются.")
+            return []
+        found = []
+        for uid in uids:
+            _, msg_data = mail.uid("fetch", str(uid), "(RFC822)")
+            if msg_data and isinstance(msg_data[0], tuple):
+                found.append((uid, email.message_from_bytes(msg_data[0][1])))
+        return found
+    finally:
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+
+def fetch_new_emails(config: dict, last_uid: int | None = None, uid_validity: int | None = None) -> tuple:
+    """
+    Забирает из INBOX письма с UID больше last_uid (не больше PIPELINE_FETCH_BATCH за раз).
+    При last_uid=None берётся только последнее письмо - как в синхронном цикле. last_uid сравнивается
+    только при том же UIDVALIDITY: если сервер перенумеровал ящик, чтение начинается заново.
+    Возвращает (UIDVALIDITY, список (uid, msg) по возрастанию UID). Ошибки IMAP пробрасываются вызывающему.
+    """
+    mail = imaplib.IMAP4_SSL(config["IMAP_SERVER"])
+    try:
+        mail.login(config["MAIL_USER"], config["MAIL_PASSWORD"])
+        current_validity = _select_inbox(mail)
+        if uid_validity is not None and current_validity != uid_validity:
+            logging.warning(f"UIDVALIDITY ящика изменился ({uid_validity} -> {current_validity}), "
+                            f"последний UID {last_uid} сброшен.")
+            last_uid = None
+        _, data = mail.uid("search", None, "ALL")
+        uids = [int(uid) for uid in data[0].split()]
+        if last_uid is None:
+            uids = uids[-1:]
+        else:
+            uids = [uid for uid in uids if uid > last_uid]
+
+        new_emails = []
+        for uid in uids[:config.get("PIPELINE_FETCH_BATCH", 20)]:
+            _, msg_data = mail.uid("fetch", str(uid), "(RFC822)")
+            new_emails.append((uid, email.message_from_bytes(msg_data[0][1])))
+        return current_validity, new_emails
+    finally:
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+
+def build_email_text(msg, config: dict) -> tuple:
+    """
+    Собирает текст письма и вложений из уже полученного сообщения.
+    Возвращает (текст письма, товары из таблиц вложений).
+    """
+    main_text_plain = ""
+    main_text_html = ""
+    attachment_jobs = []
+
+    for part in msg.walk():
+        # Пропускаем только контейнеры, остальное обрабатываем по логике ниже
+        if part.get_content_type() == "multipart/alternative":
+            continue
+
+        filename = part.get_filename()
+
+        # --- 1. СБОР ВЛОЖЕНИЙ (сам разбор идёт в пулах воркеров после обхода письма) ---
+        if filename:
+            decoded_filename = filename
+            try:
+                decoded_filename, enc = decode_header(filename)[0]
+                if isinstance(decoded_filename, bytes):
+                    decoded_filename = decoded_filename.decode(enc or "utf-8", errors="ignore")
+
+                payload = part.get_payload(decode=True)
+                if not payload:
+                    logging.warning(f"Вложение {decoded_filename} не имеет данных (пустое).")
+                    continue
+
+                extractor = find_extractor(decoded_filename, part.get_content_type())
+                if extractor and not find_extractor(decoded_filename):
+                    # Расширение не говорит о формате (или его нет) - формат определён по MIME-типу
+                    decoded_filename += extractor["extensions"][0]
+
+                if is_archive_filename(decoded_filename):
+                    # Содержимое архива раскладывается на отдельные вложения по месту архива
+                    attachment_jobs.extend(expand_archive(decoded_filename, payload, config))
+                else:
+                    attachment_jobs.append((decoded_filename, payload))
+
+            except Exception as e:
+                logging.error(f"Не удалось прочитать вложение {decoded_filename}: {e}", exc_info=True)
+                attachment_jobs.append((decoded_filename, None))
+
+        # --- 2. ОБРАБОТКА ТЕЛА ПИСЬМА ---
+        content_type = part.get_content_type()
+        if not filename and content_type.startswith("text/"):
+            charset = part.get_content_charset() or "utf-8"
+            payload = part.get_payload(decode=True)
+            if not payload:
+                continue
+
+            try:
+                body_part_text = payload.decode(charset, errors="ignore")
+                if content_type == "text/plain":
+                    main_text_plain += body_part_text + "\n"
+                elif content_type == "text/html":
+                    main_text_html += body_part_text + "\n"
+            except Exception as e:
+                logging.error(f"Ошибка декодирования тела письма (тип: {content_type}): {e}")
+
+    # Выбираем, какой текст использовать: plain-text в приоритете
+    final_main_text = main_text_plain.strip()
+    html_products = []
+    if not final_main_text and main_text_html:
+        logging.info("Plain-text версия не найдена, используется HTML-версия.")
+        final_main_text, html_products = html_to_text_and_products(main_text_html)
+
+    # --- 3. ФОРМИРОВАНИЕ ИТОГОВОГО ТЕКСТА ---
+    max_length = email_text_limit(config)
+    main_section = f"=== ТЕКСТ ПИСЬМА ===\n{final_main_text}\n\n=== ВЛОЖЕНИЯ ===\n"
+    # Вложения разбираются ровно до того места, где итоговый текст всё равно будет обрезан
+    attachments_text, table_products = extract_attachments_text(
+        attachment_jobs, config, char_budget=max(max_length - len(main_section), 0))
+    table_products = html_products + table_products
+    combined_text = main_section + attachments_text.strip()
+
+    if len(combined_text) > max_length:
+        combined_text = combined_text[:max_length] + "\n...[текст обрезан из-за превышения лимита]"
+
+    return combined_text, table_products
+
+
+# =============================
+# Функции для извлечения товаров из письма (fallback, regex, GPT)
+# =============================
+SIGNATURE_MARKERS = ["С уважением", "С уважением,"]
+
+
+def fallback_extract_products_new(email_text: str) -> list:
+    products = []
+    start = email_text.find("Номенклатура")
+    if start == -1:
+        return products
+    block = email_text[start:]
+    for marker in SIGNATURE_MARKERS:
+        idx = block.find(marker)
+        if idx != -1:
+            block = block[:idx]
+            break
+    lines = [line.strip() for line in block.splitlines() if line.strip()]
+    headers = {"Номенклатура", "Ед.изм.", "Кол-во по спец."}
+    while lines and lines[0] in headers:
+        lines.pop(0)
+    if not lines:
+        return products
+    if len(lines) % 3 != 0:
+        logging.warning("Количество строк в блоке номенклатуры не кратно 3, обработка может быть неполной.")
+    i = 0
+    while i < len(lines) - 2:
+        name = lines[i]
+        quantity_str = lines[i + 2]
+        try:
+            quantity = int(quantity_str)
+        except ValueError:
+            try:
+                quantity = float(quantity_str)
+            except ValueError:
+                quantity = 1
+        products.append({
+            "name": name,
+            "code": "",
+            "quantity": quantity,
+            "sum": 0.0
+        })
+        i += 3
+    return products
+
+# Ключевые слова шапки таблицы товаров (сравниваются без пробелов и в нижнем регистре)
+TABLE_HEADER_KEYWORDS = {
+    "quantity": ("кол-во", "количество", "кол.", "колво", "qty", "quantity"),
+    "unit": ("ед.изм", "ед.", "единица", "unit", "uom"),
+    "code": ("код", "артикул", "code", "sku"),
+    "name": ("наименование", "номенклатура", "название", "товар", "name", "description"),
+}
+TABLE_HEADER_SCAN_ROWS = 20
+TABLE_TOTAL_MARKERS = ("итого", "всего")
+
+
+def detect_product_columns(header_cells: list) -> dict | None:
+    """
+    Ищет в строке шапку таблицы товаров. Возвращает {"name": i, "quantity": j, ...}
+    или None, если нет обязательных колонок наименования и количества.
+    """
+    columns = {}
+    for i, cell in enumerate(header_cells):
+        cell_norm = re.sub(r'\s+', '', str(cell or "")).lower()
+        if not cell_norm:
+            continue
+        for field, keywords in TABLE_HEADER_KEYWORDS.items():
+            if field in columns:
+                continue
+            if any(cell_norm.startswith(k) for k in keywords) or (
+                    field == "name" and any(k in cell_norm for k in keywords)):
+                columns[field] = i
+                break
+    if "name" in columns and "quantity" in columns:
+        return columns
+    return None
+
+
+# Число в начале ячейки количества: "10", "1 000", "2,5", "10 шт", "5 м."
+TABLE_QUANTITY_PATTERN = re.compile(r'^\s*(\d[\d\s]*(?:[.,]\d+)?)\s*(.*)$')
+
+
+def _table_cell(cells: list, columns: dict, field: str) -> str:
+    i = columns.get(field)
+    return str(cells[i]).strip() if i is not None and i < len(cells) and cells[i] is not None else ""
+
+
+def table_row_is_skipped(cells: list, columns: dict) -> bool:
+    """Пустая строка или строка итогов - такие строки не нужны ни в товарах, ни в тексте."""
+    name = _table_cell(cells, columns, "name")
+    if name.lower().startswith(TABLE_TOTAL_MARKERS):
+        return True
+    return not any(str(cell).strip() for cell in cells if cell is not None)
+
+
+def table_row_to_product(cells: list, columns: dict) -> dict | None:
+    """
+    Преобразует строку таблицы в товар. Количество берётся из числа в начале ячейки,
+    единица измерения после числа ("10 шт") используется, если нет отдельной колонки.
+    None - строку не удалось разобрать (или это пустая строка / итоги, см. table_row_is_skipped).
+    """
+    def cell(field):
+        return _table_cell(cells, columns, field)
+
+    name = cell("name")
+    if not name or name.lower().startswith(TABLE_TOTAL_MARKERS):
+        return None
+    quantity_match = TABLE_QUANTITY_PATTERN.match(cell("quantity"))
+    if not quantity_match:
+        return None
+    quantity = float(re.sub(r'\s+', '', quantity_match.group(1)).replace(",", "."))
+    if quantity.is_integer():
+        quantity = int(quantity)
+    unit_suffix = quantity_match.group(2).strip()
+
+    product = {
+        "name": name,
+        "code": cell("code"),
+        "quantity": quantity,
+        "sum": 0.0
+    }
+    if cell("unit"):
+        product["unit"] = cell("unit")
+    elif re.fullmatch(r'[^\W\d_][\w.]{0,9}', unit_suffix):
+        product["unit"] = unit_suffix
+    return product
+
+
+def regex_extract_products(email_text: str) -> list:
+    products = []
+    pattern = re.compile(r'^(?P<name>.+?)\s+(?P<quantity>\d+)\s*$', re.MULTILINE)
+    for m in pattern.finditer(email_text):
+        name = m.group("name").strip()
+        try:
+            quantity = int(m.group("quantity"))
+        except ValueError:
+            quantity = 1
+        products.append({
+            "name": name,
+            "code": "",
+            "quantity": quantity,
+            "sum": 0.0
+        })
+    return products
+
+
+# =============================
+# HTTP-клиент Yandex GPT: пул соединений, таймауты, повторы с backoff
+# =============================
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+GPT_METRICS = {
+    "calls": 0,
+    "errors": 0,
+    "retries": 0,
+    "latency_total": 0.0,
+    "latency_max": 0.0,
+    "input_tokens": 0,
+    "completion_tokens": 0,
+    "tokens_saved": 0,
+}
+
+_gpt_session = None
+_gpt_rate_limiter = None
+_gpt_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket: в среднем не больше rate запросов в секунду,
+    с допустимым всплеском до burst запросов.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+def get_gpt_rate_limiter(config: dict) -> TokenBucket | None:
+    """Лимитер по квоте API (GPT_RATE_LIMIT запросов в секунду); None - без ограничения."""
+    global _gpt_rate_limiter
+    rate = config.get("GPT_RATE_LIMIT", 0)
+    if not rate:
+        return None
+    with _gpt_lock:
+        if _gpt_rate_limiter is None:
+            _gpt_rate_limiter = TokenBucket(rate, config.get("GPT_RATE_BURST", 1))
+        return _gpt_rate_limiter
+
+
+def get_gpt_session(config: dict) -> "requests.Session":
+    """Общая для всех вызовов сессия: keep-alive и пул соединений вместо TLS-рукопожатия на каждый запрос."""
+    global _gpt_session
+    with _gpt_lock:
+        if _gpt_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=config.get("GPT_POOL_SIZE", 10),
+                max_retries=0,  # повторы делаем сами, с учётом 429 и Retry-After
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _gpt_session = session
+        return _gpt_session
+
+
+def _gpt_backoff_delay(attempt: int, config: dict, retry_after: str | None = None) -> float:
+    """Экспоненциальная задержка с полным jitter; Retry-After от сервера имеет приоритет."""
+    if retry_after:
+        try:
+            return min(float(retry_after), config.get("GPT_BACKOFF_MAX", 30.0))
+        except ValueError:
+            pass
+    delay = min(config.get("GPT_BACKOFF_BASE", 1.0) * (2 ** attempt), config.get("GPT_BACKOFF_MAX", 30.0))
+    return random.uniform(0, delay)
+
+
+def _record_gpt_metrics(latency: float, response_data: dict | None):
+    usage = (response_data or {}).get("result", {}).get("usage", {})
+    input_tokens = int(usage.get("inputTextTokens", 0) or 0)
+    completion_tokens = int(usage.get("completionTokens", 0) or 0)
+    with _gpt_lock:
+        GPT_METRICS["calls"] += 1
+        GPT_METRICS["latency_total"] += latency
+        GPT_METRICS["latency_max"] = max(GPT_METRICS["latency_max"], latency)
+        GPT_METRICS["input_tokens"] += input_tokens
+        GPT_METRICS["completion_tokens"] += completion_tokens
+        calls = GPT_METRICS["calls"]
+        average = GPT_METRICS["latency_total"] / calls
+    logging.info(f"Yandex GPT: ответ за {latency:.2f} с (среднее {average:.2f} с за {calls} вызовов), "
+                 f"токены: вход {input_tokens}, ответ {completion_tokens}")
+
+
+def gpt_cache_key(payload: dict) -> str:
+    """Ключ кэша ответов: хэш промпта, модели и параметров генерации."""
+    key_source = json.dumps(
+        {
+            "modelUri": payload.get("modelUri"),
+            "completionOptions": payload.get("completionOptions"),
+            "messages": payload.get("messages"),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+def yandex_gpt_request(payload: dict, config: dict, headers: dict) -> dict:
+    """
+    Отправляет запрос к Yandex GPT через общую сессию и возвращает JSON ответа.
+    Успешные ответы кэшируются на диске (GPT_CACHE_FOLDER) с TTL, поэтому повторная обработка
+    того же письма (после сбоя, рестарта или при отладке) не делает сетевых вызовов.
+    Сетевые ошибки, таймауты, 429 и 5xx повторяются до GPT_MAX_RETRIES раз.
+    После последней попытки пробрасывает requests.exceptions.RequestException, как и requests.post.
+    """
+    cache_folder = config.get("GPT_CACHE_FOLDER", "gpt_cache")
+    cache_key = gpt_cache_key(payload)
+    if cache_folder:
+        cached = disk_cache_get(cache_folder, cache_key, "gpt", ttl=config.get("GPT_CACHE_TTL", 7 * 24 * 3600))
+        if cached is not None:
+            logging.info(f"Ответ Yandex GPT взят из кэша (hit rate {cache_hit_rate('gpt'):.0%}).")
+            return cached["response"]
+
+    session = get_gpt_session(config)
+    rate_limiter = get_gpt_rate_limiter(config)
+    timeout = (config.get("GPT_CONNECT_TIMEOUT", 5), config.get("GPT_READ_TIMEOUT", 60))
+    max_retries = config.get("GPT_MAX_RETRIES", 3)
+    started = time.monotonic()
+
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            response = session.post(config["YANDEX_GPT_API_ENDPOINT"], headers=headers, json=payload,
+                                    timeout=timeout)
+            if response.status_code in RETRYABLE_STATUS_CODES and attempt < max_retries:
+                retry_after = response.headers.get("Retry-After")
+                logging.warning(f"Yandex GPT вернул {response.status_code}, повтор {attempt + 1} из {max_retries}")
+            else:
+                response.raise_for_status()
+                response_data = response.json()
+                _record_gpt_metrics(time.monotonic() - started, response_data)
+                if cache_folder and response_data.get("result", {}).get("alternatives"):
+                    disk_cache_put(cache_folder, cache_key, {"response": response_data}, "gpt",
+                                   config.get("GPT_CACHE_MAX_MB", 256) * 1024 * 1024)
+                return response_data
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= max_retries:
+                with _gpt_lock:
+                    GPT_METRICS["errors"] += 1
+                raise
+            logging.warning(f"Сетевая ошибка Yandex GPT ({e}), повтор {attempt + 1} из {max_retries}")
+        except requests.exceptions.RequestException:
+            with _gpt_lock:
+                GPT_METRICS["errors"] += 1
+            raise
+
+        with _gpt_lock:
+            GPT_METRICS["retries"] += 1
+        time.sleep(_gpt_backoff_delay(attempt, config, retry_after))
+
+
+class GPTUnavailableError(Exception):
+    """GPT не ответил (сеть, таймаут, 5xx после всех повторов) - письмо стоит обработать позже."""
+
+
+# =============================
+# Сокращение текста письма перед GPT
+# =============================
+# Начало цитаты предыдущих писем в ответе: всё ниже этой строки - история переписки.
+# Пересланные письма ("Forwarded message", "Пересылаемое сообщение") цитатой не считаются:
+# менеджер часто пересылает заказ клиента, и весь заказ находится именно в пересланной части.
+QUOTE_START_PATTERN = re.compile(
+    r'^\s*(?:-{2,}\s*(?:Original Message|Исходное сообщение)'
+    r'|On .{5,200} wrote:\s*$'
+    r'|.{0,100}\d{1,2}[./]\d{1,2}[./]\d{2,4}.{0,100}(?:пишет|написал\(а\)|wrote):\s*$)',
+    re.IGNORECASE | re.MULTILINE)
+# Начало пересланного письма: подпись пересылающего заканчивается перед ним
+FORWARD_START_PATTERN = re.compile(
+    r'^\s*(?:-{2,}\s*(?:Forwarded message|Пересылаемое сообщение|Пересланное сообщение)'
+    r'|Начало переадресованного сообщения:)',
+    re.IGNORECASE | re.MULTILINE)
+# Блок товаров в выгрузке из 1С: строки идут абзацами "наименование / ед. / кол-во" до подписи
+NOMENCLATURE_BLOCK_PATTERN = re.compile(r'^\s*номенклатура\b', re.IGNORECASE | re.MULTILINE)
+DISCLAIMER_PATTERN = re.compile(
+    r'конфиденциальн|предназначен[оа]? исключительно|получили это (?:письмо|сообщение) по ошибке'
+    r'|disclaimer|this e-?mail (?:and any|is intended)|intended solely',
+    re.IGNORECASE)
+REQUISITE_LINE_PATTERN = re.compile(
+    r'ИНН|КПП|ОГРН|БИК|р/с|к/с|расч[её]тн|корр?\.?\s*сч|адрес|тел\b|тел\.|телефон|моб\.|e-?mail|@'
+    r'|\b(?:ООО|АО|ЗАО|ПАО|ОАО|ИП)\b|\+7|(?<!\d)8\s*\(\d{3}\)',
+    re.IGNORECASE)
+REQUISITE_NUMBER_PATTERN = re.compile(
+    r'(?:ИНН|КПП|ОГРН|ОКПО|БИК|р/с|к/с|тел\.?|телефон)[\s:№.]*\+?[\d\s()\-]*\d', re.IGNORECASE)
+PRODUCT_LINE_PATTERN = re.compile(
+    r'\d+[.,]?\d*\s*[xх*×]\s*\d+|\b(?:ду|dn|ру|pn)\s*\d+|гост|номенклатура|наименование|кол-?во|количество'
+    r'|\d+[.,]?\d*\s*(?:шт|м|кг|т|компл|пог\.?\s*м)\b\.?|[а-яa-z].*[\t ]\d+[.,]?\d*\s*$',
+    re.IGNORECASE)
+ATTACHMENT_HEADER_PATTERN = re.compile(r'^--- СОДЕРЖИМОЕ ВЛОЖЕНИЯ: .* ---$', re.MULTILINE)
+
+_product_keywords_pattern = None
+
+
+def _is_product_line(line: str) -> bool:
+    global _product_keywords_pattern
+    if _product_keywords_pattern is None:
+        keywords = [synonym for product_type, synonyms in (synonyms_type or {}).items()
+                    if product_type.lower() != "комментарий" for synonym in synonyms]
+        alternatives = "|".join(re.escape(k.lower()) for k in sorted(keywords, key=len, reverse=True))
+        _product_keywords_pattern = re.compile(rf'(?<!\w)(?:{alternatives})(?!\w)' if alternatives else r'(?!)')
+    return bool(PRODUCT_LINE_PATTERN.search(line) or _product_keywords_pattern.search(line.lower()))
+
+
+def _is_relevant_line(line: str) -> bool:
+    return bool(REQUISITE_LINE_PATTERN.search(line)) or _is_product_line(line)
+
+
+def _relevant_kinds(text: str) -> set:
+    """Какие данные заказа есть в тексте: "requisites" (реквизиты) и/или "products" (товарные строки)."""
+    kinds = set()
+    for line in text.splitlines():
+        if REQUISITE_LINE_PATTERN.search(line):
+            kinds.add("requisites")
+        # "ИНН 7701234567" похожа на товарную строку (текст и число в конце), номера реквизитов не считаем
+        if _is_product_line(REQUISITE_NUMBER_PATTERN.sub("", line)):
+            kinds.add("products")
+    return kinds
+
+
+def _safe_to_drop(kept: str, dropped: str) -> bool:
+    """Отбрасываемая часть не содержит реквизитов или товаров, которых нет в остающейся."""
+    return _relevant_kinds(dropped) <= _relevant_kinds(kept)
+
+
+def _unique_paragraphs(text: str, seen: set) -> list:
+    """Все абзацы текста, без дисклеймеров и без повторов."""
+    kept = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        key = re.sub(r'\s+', ' ', paragraph).lower()
+        if not paragraph or key in seen or DISCLAIMER_PATTERN.search(paragraph):
+            continue
+        seen.add(key)
+        kept.append(paragraph)
+    return kept
+
+
+def _relevant_paragraphs(text: str, seen: set) -> list:
+    """
+    Оставляет абзацы с реквизитами или товарами, без дисклеймеров и без повторов.
+    Блок "Номенклатура" остаётся целиком до подписи: строка вида "Электроды УОНИ" с единицей
+    и количеством в отдельных строках товарной по шаблонам не распознаётся.
+    """
+    kept = []
+    in_nomenclature = False
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if NOMENCLATURE_BLOCK_PATTERN.search(paragraph):
+            in_nomenclature = True
+        elif any(paragraph.startswith(marker) for marker in SIGNATURE_MARKERS):
+            in_nomenclature = False
+        key = re.sub(r'\s+', ' ', paragraph).lower()
+        if not paragraph or key in seen or DISCLAIMER_PATTERN.search(paragraph):
+            continue
+        if in_nomenclature or any(_is_relevant_line(line) for line in paragraph.splitlines()):
+            seen.add(key)
+            kept.append(paragraph)
+    return kept
+
+
+def reduce_email_for_gpt(email_text: str) -> tuple:
+    """
+    Сокращает текст письма перед отправкой в GPT:
+    - отрезает цитируемую историю переписки и строки с ">", если только в них не единственные
+      реквизиты или товары письма; пересланные письма не трогает;
+    - в подписи (после последнего абзаца "С уважением ..." и до пересланного письма) и во вложениях
+      оставляет только абзацы с реквизитами, товарными строками и блоки "Номенклатура",
+      дисклеймеры выбрасывает;
+    - убирает повторяющиеся абзацы.
+    Возвращает (сокращённый текст, сэкономлено токенов).
+    """
+    body, separator, attachments = email_text.partition("=== ВЛОЖЕНИЯ ===")
+
+    quote = QUOTE_START_PATTERN.search(body)
+    if quote and _safe_to_drop(body[:quote.start()], body[quote.start():]):
+        body = body[:quote.start()]
+    unquoted = [line for line in body.splitlines() if not line.lstrip().startswith(">")]
+    quoted = [line for line in body.splitlines() if line.lstrip().startswith(">")]
+    if _safe_to_drop("\n".join(unquoted), "\n".join(quoted)):
+        body = "\n".join(unquoted)
+
+    # Подпись ищем по последнему "С уважением": выше может быть подпись менеджера, переславшего заказ
+    signature = forwarded = ""
+    start = max(body.rfind(marker) for marker in SIGNATURE_MARKERS)
+    if start != -1:
+        forward = FORWARD_START_PATTERN.search(body, start)
+        end = forward.start() if forward else len(body)
+        body, signature, forwarded = body[:start], body[start:end], body[end:]
+
+    seen = set()
+    body_paragraphs = _unique_paragraphs(body, seen)
+    if signature:
+        # Первый абзац подписи - "С уважением" и имя контактного лица, он нужен всегда
+        first_paragraph, _, signature = signature.partition("\n\n")
+        body_paragraphs.append(first_paragraph.strip())
+        body_paragraphs += _relevant_paragraphs(signature, seen)
+    body_paragraphs += _unique_paragraphs(forwarded, seen)
+    reduced = "\n\n".join(body_paragraphs)
+
+    if separator:
+        reduced += f"\n\n{separator}\n"
+        sections = ATTACHMENT_HEADER_PATTERN.split(attachments)
+        headers = ATTACHMENT_HEADER_PATTERN.findall(attachments)
+        for header, section in zip(headers, sections[1:]):
+            paragraphs = _relevant_paragraphs(section, seen)
+            if paragraphs:
+                reduced += f"\n{header}\n" + "\n\n".join(paragraphs) + "\n"
+
+    saved_tokens = max(estimate_tokens(email_text) - estimate_tokens(reduced), 0)
+    return reduced.strip(), saved_tokens
+
+
+def prepare_gpt_text(email_text: str, config: dict) -> str:
+    """Сокращает текст письма (если не отключено GPT_PROMPT_REDUCTION) и учитывает экономию токенов."""
+    if not config.get("GPT_PROMPT_REDUCTION", True):
+        return email_text
+    reduced, saved_tokens = reduce_email_for_gpt(email_text)
+    with _gpt_lock:
+        GPT_METRICS["tokens_saved"] += saved_tokens
+    logging.info(f"Сокращение промпта: {len(email_text)} -> {len(reduced)} символов, "
+                 f"сэкономлено ~{saved_tokens} токенов (всего ~{GPT_METRICS['tokens_saved']}).")
+    return reduced
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов YandexGPT: около 3 символов на токен для русского текста."""
+    return len(text) // 3 + 1
+
+
+def split_text_into_chunks(text: str, max_tokens: int) -> list:
+    """
+    Делит текст на куски не больше max_tokens по границам строк.
+    Строка длиннее лимита режется по символам, но не теряется.
+    """
+    max_chars = max_tokens * 3
+    chunks = []
+    current = []
+    current_len = 0
+    for line in text.splitlines():
+        while len(line) > max_chars:
+            if current:
+                chunks.append("\n".join(current))
+                current, current_len = [], 0
+            chunks.append(line[:max_chars])
+            line = line[max_chars:]
+        if current and current_len + len(line) + 1 > max_chars:
+            chunks.append("\n".join(current))
+            current, current_len = [], 0
+        current.append(line)
+        current_len += len(line) + 1
+    if current and any(line.strip() for line in current):
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def merge_products(product_lists: list) -> list:
+    """
+    Объединяет списки товаров из кусков в исходном порядке. Куски не перекрываются, поэтому
+    одинаковые позиции - это повторяющиеся строки спецификации, и они не схлопываются.
+    """
+    return [product for products in product_lists for product in products if isinstance(product, dict)]
+
+
+def gpt_extract_products_chunked(email_text: str) -> list:
+    """
+    Извлекает товары из длинного текста: режет его на куски по GPT_CHUNK_TOKENS токенов,
+    отправляет куски параллельно (не больше GPT_MAX_CONCURRENCY одновременно) и сливает результат.
+    Кусок, по которому GPT ничего не вернул, разбирается локальным regex, чтобы строки не пропадали молча;
+    если и regex ничего не нашёл, это логируется как ошибка. Сбой запроса по любому куску -
+    GPTUnavailableError: письмо обрабатывается повторно, а не заполняется результатом regex.
+    """
+    chunk_tokens = config.get("GPT_CHUNK_TOKENS", 1500)
+    chunks = split_text_into_chunks(email_text, chunk_tokens)
+    logging.info(f"Извлечение товаров по частям: {len(chunks)} кусков по ~{chunk_tokens} токенов.")
+    max_output_tokens = str(min(config.get("GPT_CHUNK_MAX_OUTPUT_TOKENS", 4000), chunk_tokens * 2 + 200))
+
+    with ThreadPoolExecutor(max_workers=config.get("GPT_MAX_CONCURRENCY", 4),
+                            thread_name_prefix="gpt-chunk") as pool:
+        results = list(pool.map(
+            functools.partial(gpt_extract_products, chunked=False, max_tokens=max_output_tokens, reduce=False),
+            chunks))
+
+    for i, (chunk, products) in enumerate(zip(chunks, results)):
+        if not products:
+            fallback_products = regex_extract_products(chunk)
+            if fallback_products:
+                logging.warning(f"GPT не вернул товаров для куска {i + 1}, использован regex: {len(fallback_products)} позиций.")
+                results[i] = fallback_products
+            else:
+                first_line = next((line.strip() for line in chunk.splitlines() if line.strip()), "")
+                logging.error(f"Из куска {i + 1} из {len(chunks)} не извлечено ни одной позиции "
+                              f"(начало куска: '{first_line[:100]}').")
+
+    products = merge_products(results)
+    logging.info(f"Извлечение товаров по частям: итого {len(products)} позиций.")
+    return products
+
+
+def gpt_extract_products(email_text: str, chunked: bool | None = None, max_tokens: str = "1500",
+                         reduce: bool = True) -> list:
+    """
+    Извлекает товары через GPT. В режиме GPT_CHUNKING (или chunked=True) текст,
+    не помещающийся в один запрос, обрабатывается по частям параллельно.
+    reduce=False - текст уже сокращён (куски длинного письма).
+    Пустой список - ответ GPT не разобран; недоступность GPT - исключение GPTUnavailableError.
+    """
+    if reduce:
+        email_text = prepare_gpt_text(email_text, config)
+    if chunked is None:
+        chunked = config.get("GPT_CHUNKING", False)
+    if chunked and estimate_tokens(email_text) > config.get("GPT_CHUNK_TOKENS", 1500):
+        return gpt_extract_products_chunked(email_text)
+
+    headers = {
+        "Authorization": f"Api-Key {config['YANDEX_SA_API_KEY']}",
         "Content-Type": "application/json"
     }
 
@@ -876,16 +2624,14 @@ def gpt_extract_products(email_text: str) -> list:
 
     payload = {
         "modelUri": config["YANDEX_GPT_MODEL_URI_PATTERN"],
-        "completionOptions": {"stream": False, "temperature": 0.0, "maxTokens": "1500"},
+        "completionOptions": {"stream": False, "temperature": 0.0, "maxTokens": max_tokens},
         "messages": [{"role": "user", "text": prompt_text}]
     }
 
     try:
         logging.debug(
             f"Запрос на извлечение товаров к Yandex GPT API: Payload={json.dumps(payload, ensure_ascii=False)[:300]}...")
-        response = requests.post(config["YANDEX_GPT_API_ENDPOINT"], headers=headers, json=payload)
-        response.raise_for_status()
-        response_data = response.json()
+        response_data = yandex_gpt_request(payload, config, headers)
         result_text_raw = ""
 
         if 'result' in response_data and 'alternatives' in response_data['result'] and \
@@ -915,14 +2661,14 @@ def gpt_extract_products(email_text: str) -> list:
         logging.error(f"Ошибка вызова Yandex GPT API для извлечения товаров: {e}")
         if hasattr(e, 'response') and e.response is not None:
             logging.error(f"Содержимое ответа Yandex GPT API: {e.response.text}")
-        return []
+        raise GPTUnavailableError(str(e)) from e
     except json.JSONDecodeError as e:
         logging.error(
             f"Yandex GPT вернул некорректный JSON для извлечения товаров (после очистки): '{result_text_cleaned if 'result_text_cleaned' in locals() else 'Нет очищенного ответа'}'. Ошибка: {e}")
         return []
     except Exception as e:
         logging.error(f"Неизвестная ошибка при извлечении товаров через Yandex GPT: {e}", exc_info=True)
-        return []
+        raise GPTUnavailableError(str(e)) from e
 
 def extract_products_multifallback(email_text: str) -> list:
     products = fallback_extract_products_new(email_text)
@@ -943,7 +2689,9 @@ def extract_products_multifallback(email_text: str) -> list:
 # =============================
 # Функция анализа письма через GPT для извлечения данных заказа
 # =============================
-def analyze_email_with_gpt(email_text: str, config: dict) -> dict:
+def analyze_email_with_gpt(email_text: str, config: dict, include_products: bool = True) -> dict:
+    # include_products=False - запрашиваются только реквизиты (товары уже извлечены локально)
+    # Пустой словарь - ответ GPT не разобран; недоступность GPT - исключение GPTUnavailableError
     # Используем API-ключ сервисного аккаунта для аутентификации
     headers = {
         "Authorization": f"Api-Key {config['YANDEX_SA_API_KEY']}", # ИЗМЕНЕНО: Используем YANDEX_SA_API_KEY
@@ -971,19 +2719,35 @@ def analyze_email_with_gpt(email_text: str, config: dict) -> dict:
         "Если какая-либо информация не найдена, оставь поле пустым."
         "Важно: ответ должен быть строго в формате JSON-массива, без обрамления в markdown ```json ... ```.\n"  # Добавлено уточнение
     )
-    user_prompt = f"Текст письма:\n{email_text}"
+    max_tokens = "2000"
+    if not include_products:
+        system_prompt = (
+            "Ты AI-помощник для обработки заказов. Твоя задача – извлечь из текста письма реквизиты заказчика. "
+            "Список товаров извлекать не нужно.\n\n"
+            "Извлеки следующие данные:\n"
+            "- Данные компании: name, INN, KPP, legal_address, actual_address, checking_account.\n"
+            "- Данные контактного лица: full_name, email, phone.\n"
+            "- Дату заказа\n\n"
+            "Выдай корректный JSON по следующей структуре:\n"
+            "{\n"
+            "  \"company\": {\"name\": \"\", \"INN\": \"\", \"KPP\": \"\", \"legal_address\": \"\", \"actual_address\": \"\", \"checking_account\": \"\"},\n"
+            "  \"order\": {\"contact_person\": {\"full_name\": \"\", \"email\": \"\", \"phone\": \"\"}, \"datetime\": \"\"}\n"
+            "}\n"
+            "Если какая-либо информация не найдена, оставь поле пустым. "
+            "Важно: ответ должен быть строго в формате JSON, без обрамления в markdown ```json ... ```.\n"
+        )
+        max_tokens = "800"
+    user_prompt = f"Текст письма:\n{cut_email_text(prepare_gpt_text(email_text, config), config)}"
     payload = {
         "modelUri": config["YANDEX_GPT_MODEL_URI_PATTERN"],
-        "completionOptions": {"stream": False, "temperature": 0.0, "maxTokens": "2000"},
+        "completionOptions": {"stream": False, "temperature": 0.0, "maxTokens": max_tokens},
         "messages": [{"role": "system", "text": system_prompt}, {"role": "user", "text": user_prompt}]
     }
 
     try:
         logging.debug(
             f"Запрос к Yandex GPT API: URL={config['YANDEX_GPT_API_ENDPOINT']}, Headers Auth Key={headers['Authorization'][:15]}..., Payload={json.dumps(payload, ensure_ascii=False)[:500]}...")
-        response = requests.post(config["YANDEX_GPT_API_ENDPOINT"], headers=headers, json=payload)
-        response.raise_for_status()
-        response_data = response.json()
+        response_data = yandex_gpt_request(payload, config, headers)
         gpt_text_raw = ""
 
         if 'result' in response_data and 'alternatives' in response_data['result'] and \
@@ -1014,17 +2778,869 @@ def analyze_email_with_gpt(email_text: str, config: dict) -> dict:
         logging.error(f"Ошибка вызова Yandex GPT API: {e}")
         if hasattr(e, 'response') and e.response is not None:
             logging.error(f"Содержимое ответа Yandex GPT API: {e.response.text}")
-        return {}
+        raise GPTUnavailableError(str(e)) from e
     except Exception as e:
         logging.error(f"Неизвестная ошибка при работе с Yandex GPT: {e}", exc_info=True)
+        raise GPTUnavailableError(str(e)) from e
+
+# =============================
+# Локальное извлечение реквизитов и товаров (без GPT)
+# =============================
+INN_KPP_PATTERN = re.compile(r'ИНН\s*/\s*КПП\s*[:№]?\s*(\d{10})\s*/\s*(\d{9})\b', re.IGNORECASE)
+INN_PATTERN = re.compile(r'\bИНН\s*[:№]?\s*(\d{12}|\d{10})\b', re.IGNORECASE)
+KPP_PATTERN = re.compile(r'\bКПП\s*[:№]?\s*(\d{9})\b', re.IGNORECASE)
+CHECKING_ACCOUNT_PATTERN = re.compile(r'\b(?:р/с|р/сч|расч[её]тный\s+сч[её]т)\s*[:№]?\s*(\d{20})\b', re.IGNORECASE)
+PHONE_PATTERN = re.compile(r'(?<!\d)(\+?[78][\s\-(]*\d{3}[\s\-)]*\d{3}[\s\-]*\d{2}[\s\-]*\d{2})(?!\d)')
+EMAIL_PATTERN = re.compile(r'[\w.+\-]+@[\w\-]+(?:\.[\w\-]+)+')
+COMPANY_PATTERN = re.compile(
+    r'\b((?:ООО|АО|ЗАО|ПАО|ОАО|НАО)\s*[«"“][^»"”\n]{2,100}[»"”]|ИП\s+[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ]\.\s*[А-ЯЁ]\.)?)')
+CONTACT_NAME_PATTERN = re.compile(r'С уважением,?\s*\n+\s*(?:[^\n]*\n+\s*)?([А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+){1,2})')
+
+# Вес каждого реквизита в оценке уверенности (в сумме 1.0)
+REQUISITES_WEIGHTS = {"INN": 0.4, "KPP": 0.15, "name": 0.25, "phone": 0.1, "email": 0.1}
+
+
+def inn_checksum_valid(inn: str) -> bool:
+    """Проверка контрольных цифр ИНН (10 цифр - организация, 12 - ИП/физлицо)."""
+    def check_digit(digits, weights):
+        return sum(int(d) * w for d, w in zip(digits, weights)) % 11 % 10
+
+    if len(inn) == 10 and inn.isdigit():
+        return check_digit(inn, (2, 4, 10, 3, 5, 9, 4, 6, 8)) == int(inn[9])
+    if len(inn) == 12 and inn.isdigit():
+        return (check_digit(inn, (7, 2, 4, 10, 3, 5, 9, 4, 6, 8)) == int(inn[10])
+                and check_digit(inn, (3, 7, 2, 4, 10, 3, 5, 9, 4, 6, 8)) == int(inn[11]))
+    return False
+
+
+def extract_requisites_local(email_text: str, config: dict) -> tuple:
+    """
+    Извлекает реквизиты скомпилированными регулярными выражениями.
+    Возвращает (company, contact_person, уверенность 0..1).
+    """
+    company = {"name": "", "INN": "", "KPP": "", "legal_address": "", "actual_address": "", "checking_account": ""}
+    contact = {"full_name": "", "email": "", "phone": ""}
+    scores = {}
+
+    inn_kpp = INN_KPP_PATTERN.search(email_text)
+    if inn_kpp:
+        company["INN"], company["KPP"] = inn_kpp.group(1), inn_kpp.group(2)
+    else:
+        inn = INN_PATTERN.search(email_text)
+        kpp = KPP_PATTERN.search(email_text)
+        if inn:
+            company["INN"] = inn.group(1)
+        if kpp:
+            company["KPP"] = kpp.group(1)
+
+    if company["INN"]:
+        # ИНН с неверной контрольной суммой - скорее опечатка или чужой номер, доверяем ему меньше
+        scores["INN"] = 1.0 if inn_checksum_valid(company["INN"]) else 0.3
+    if company["KPP"] or len(company["INN"]) == 12:
+        scores["KPP"] = 1.0  # у ИП (ИНН из 12 цифр) КПП нет
+
+    account = CHECKING_ACCOUNT_PATTERN.search(email_text)
+    if account:
+        company["checking_account"] = account.group(1)
+
+    company_name = COMPANY_PATTERN.search(email_text)
+    if company_name:
+        company["name"] = " ".join(company_name.group(1).split())
+        scores["name"] = 1.0
+
+    phone = PHONE_PATTERN.search(email_text)
+    if phone:
+        contact["phone"] = phone.group(1).strip()
+        scores["phone"] = 1.0
+
+    own_mailbox = str(config.get("MAIL_USER", "")).lower()
+    for match in EMAIL_PATTERN.finditer(email_text):
+        if match.group(0).lower() != own_mailbox:
+            contact["email"] = match.group(0)
+            scores["email"] = 1.0
+            break
+
+    contact_name = CONTACT_NAME_PATTERN.search(email_text)
+    if contact_name:
+        contact["full_name"] = contact_name.group(1)
+
+    confidence = sum(REQUISITES_WEIGHTS[field] * score for field, score in scores.items())
+    return company, contact, confidence
+
+
+def extract_products_local(email_text: str, table_products: list) -> tuple:
+    """
+    Извлекает товары без GPT. Возвращает (products, уверенность 0..1).
+    Таблицы вложений и 1С-блок "Номенклатура / Ед.изм. / Кол-во" надёжны,
+    построчный regex даёт много ложных срабатываний и получает низкую оценку.
+    """
+    if table_products:
+        return table_products, 1.0
+
+    products = fallback_extract_products_new(email_text)
+    if products:
+        # Если тройки "название / ед.изм. / кол-во" сбились, в названия попадают единицы или числа
+        aligned = all(
+            not re.fullmatch(r'[\d.,\s]*|шт\.?|м\.?|кг\.?|т\.?|компл\.?|пог\.?\s*м\.?', p["name"].lower())
+            for p in products)
+        return products, 0.9 if aligned else 0.5
+
+    products = regex_extract_products(email_text)
+    if products:
+        return products, 0.4
+    return [], 0.0
+
+
+def analyze_email_local_first(email_text: str, table_products: list, config: dict) -> dict:
+    """
+    Сначала извлекает заказ локально и вызывает GPT только для того, в чём не уверена:
+    - реквизиты и товары уверенные - GPT не вызывается вовсе;
+    - уверенные только товары - GPT запрашивается лишь за реквизитами;
+    - уверенные только реквизиты - GPT извлекает только товары;
+    - иначе полный анализ GPT, а пустые поля дополняются локальными значениями.
+    Порог уверенности - LOCAL_FIRST_THRESHOLD.
+    """
+    threshold = config.get("LOCAL_FIRST_THRESHOLD", 0.8)
+    company, contact, requisites_confidence = extract_requisites_local(email_text, config)
+    products, products_confidence = extract_products_local(email_text, table_products)
+    logging.info(f"Локальное извлечение: уверенность реквизитов {requisites_confidence:.2f}, "
+                 f"товаров {products_confidence:.2f} (порог {threshold})")
+
+    local_data = {
+        "company": company,
+        "order": {"contact_person": contact, "products": products, "datetime": ""},
+    }
+    requisites_ok = requisites_confidence >= threshold
+    products_ok = products_confidence >= threshold
+    # Источник товаров: "local" и "gpt_extract_products" уже разобрали весь текст, а не только его начало
+    local_data["products_source"] = "local"
+
+    if requisites_ok and products_ok:
+        logging.info("Заказ извлечён локально, запрос к GPT не нужен.")
+        return local_data
+
+    if requisites_ok:
+        logging.info("Реквизиты извлечены локально, через GPT извлекаются только товары.")
+        try:
+            gpt_products = gpt_extract_products(email_text)
+        except GPTUnavailableError:
+            # Как и при полном анализе: есть локальные товары - письмо не откладываем
+            if not products:
+                raise
+            gpt_products = []
+        local_data["order"]["products"] = gpt_products or products
+        if gpt_products:
+            local_data["products_source"] = "gpt_extract_products"
+        return local_data
+
+    try:
+        gpt_data = analyze_email_with_gpt(email_text, config, include_products=not products_ok)
+    except GPTUnavailableError:
+        # GPT недоступен - лучше отдать то, что нашли локально, чем откладывать письмо
+        if products or company["INN"]:
+            return local_data
+        raise
+    if not gpt_data:
+        return local_data if (products or company["INN"]) else {}
+    if not isinstance(gpt_data, dict):
+        logging.error(f"Yandex GPT вернул не объект, а {type(gpt_data)}; используются локальные данные.")
+        return local_data
+
+    gpt_company = gpt_data.setdefault("company", {})
+    gpt_order = gpt_data.setdefault("order", {})
+    gpt_contact = gpt_order.setdefault("contact_person", {})
+    # Проверенные регулярками ИНН/КПП надёжнее ответа модели, остальное дополняем только пустое
+    for field in ("INN", "KPP"):
+        if company[field] and (field != "INN" or inn_checksum_valid(company[field])):
+            gpt_company[field] = company[field]
+    for field, value in company.items():
+        if value and not gpt_company.get(field):
+            gpt_company[field] = value
+    for field, value in contact.items():
+        if value and not gpt_contact.get(field):
+            gpt_contact[field] = value
+    if products_ok:
+        gpt_order["products"] = products
+        gpt_data["products_source"] = "local"
+    return gpt_data
+
+
+# =============================
+# Анализ письма: GPT + запасные методы извлечения товаров
+# =============================
+# Служебные строки текста письма: заголовки разделов и вложений, имена листов, пометки о таблицах
+TEXT_SERVICE_LINE_PATTERN = re.compile(
+    r'^(?:=== .* ===|--- СОДЕРЖИМОЕ ВЛОЖЕНИЯ: .* ---|Лист: .*|\[Таблица товаров: .*\])$', re.MULTILINE)
+
+
+def has_products_outside_tables(email_text: str) -> bool:
+    """
+    В тексте письма остались товарные строки: строки таблиц, не разобранные в товары,
+    товары в теле письма или в других вложениях. Разобранные строки таблиц в текст не попадают.
+    """
+    text = TEXT_SERVICE_LINE_PATTERN.sub("", email_text)
+    return "products" in _relevant_kinds(text)
+
+
+def analyze_order(email_text: str, table_products: list, config: dict) -> dict:
+    """
+    Извлекает данные заказа из текста письма. Товары из таблиц вложений имеют приоритет:
+    если таблицы покрывают все товарные строки, у GPT запрашиваются только реквизиты,
+    иначе товары из остального текста извлекаются отдельно и добавляются к табличным.
+    При пустом списке товаров используется многоступенчатое извлечение.
+    Возвращает пустой словарь, если данные заказа получить не удалось.
+    Если GPT недоступен, пробрасывает GPTUnavailableError.
+    """
+    logging.info("Первые 5000 символов письма:\n%s", email_text[:5000])
+    tables_cover_order = bool(table_products) and not has_products_outside_tables(email_text)
+    if config.get("LOCAL_FIRST_MODE"):
+        logging.info("Письмо получено. Анализирую письмо локально, GPT - по необходимости...")
+        # Если таблицы покрывают не всё, локальный разбор ищет товары в остальном тексте
+        order_data = analyze_email_local_first(email_text, table_products if tables_cover_order else [], config)
+    else:
+        logging.info("Письмо получено. Анализирую письмо через GPT...")
+        # Товары из таблиц уже есть - у GPT запрашиваются только реквизиты
+        order_data = analyze_email_with_gpt(email_text, config, include_products=not table_products)
+    if not order_data:
+        logging.error("Не удалось извлечь данные заказа из письма.")
+        return {}
+    logging.info("Извлеченные данные заказа:\n%s", json.dumps(order_data, ensure_ascii=False, indent=2))
+
+    if tables_cover_order:
+        logging.info(f"Товары взяты напрямую из таблиц вложений: {len(table_products)} позиций.")
+        order_data.setdefault("order", {})["products"] = table_products
+    elif table_products:
+        if config.get("LOCAL_FIRST_MODE"):
+            text_products = order_data.get("order", {}).get("products") or []
+        else:
+            text_products = gpt_extract_products(email_text)
+        if not text_products:
+            text_products = extract_products_multifallback(email_text)
+        if not text_products:
+            logging.warning("Вне таблиц вложений есть товарные строки, но извлечь из них товары не удалось.")
+        logging.info(f"Товары из таблиц вложений: {len(table_products)} позиций, "
+                     f"из остального текста: {len(text_products)} позиций.")
+        order_data.setdefault("order", {})["products"] = table_products + text_products
+    elif (config.get("GPT_CHUNKING") and not order_data.get("products_source")
+          and len(email_text) > config.get("MAX_EMAIL_TEXT_LENGTH", 10000)):
+        # GPT-анализ видел только начало письма - товары извлекаем из всего текста по частям
+        logging.info("Письмо длиннее лимита одного запроса, товары извлекаются по частям.")
+        chunked_products = gpt_extract_products(email_text, chunked=True)
+        if chunked_products:
+            order_data.setdefault("order", {})["products"] = chunked_products
+    if not order_data.get("order", {}).get("products"):
+        logging.info("Список товаров пуст, пробую извлечь товары с многоступенчатым методом.")
+        fallback_products = extract_products_multifallback(email_text)
+        logging.info("Многоступенчатое извлечение товаров вернуло: %s", fallback_products)
+        if fallback_products:
+            order_data.setdefault("order", {})["products"] = fallback_products
+        else:
+            logging.warning("Не удалось извлечь товары ни одним методом.")
+
+    order_data["email_text"] = email_text
+    return order_data
+
+
+# =============================
+# Журнал обработанных писем (SQLite)
+# =============================
+# Письмо идентифицируется по Message-ID (без него - по UID). Для каждого письма хранится
+# последняя пройденная стадия, время стадий и их результаты (текст письма, данные заказа),
+# поэтому после перезапуска обработка продолжается с последней завершённой стадии
+# без повторного OCR и запросов к GPT. Поиск идёт по первичному ключу.
+# На финальной стадии результаты удаляются: они нужны только для продолжения обработки.
+# UID имеют смысл только вместе с UIDVALIDITY ящика, поэтому он тоже хранится в журнале.
+LEDGER_STAGES = ("fetched", "extracted", "analyzed", "written")
+LEDGER_FINAL_STAGES = ("written", "failed")
+
+_message_ledger = None
+_ledger_init_lock = threading.Lock()
+
+
+class MessageLedger:
+    """Потокобезопасный журнал стадий обработки писем в SQLite (режим WAL)."""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                message_key TEXT PRIMARY KEY,
+                uid INTEGER,
+                stage TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                timings TEXT NOT NULL DEFAULT '{}',
+                email_text TEXT,
+                table_products TEXT,
+                order_data TEXT,
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_uid ON messages (uid)")
+        # Незавершённых писем мало, частичный индекс не растёт вместе с журналом
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_unfinished ON messages (updated_at) "
+                          "WHERE stage NOT IN ('written', 'failed')")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL) "
+                          "WITHOUT ROWID")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS mailbox (name TEXT PRIMARY KEY, value INTEGER NOT NULL) "
+                          "WITHOUT ROWID")
+        self.conn.commit()
+
+    def get(self, key: str) -> dict | None:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT uid, stage, attempts, timings, email_text, table_products, order_data "
+                "FROM messages WHERE message_key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "uid": row[0],
+            "stage": row[1],
+            "attempts": row[2],
+            "timings": json.loads(row[3]),
+            "email_text": row[4],
+            "table_products": json.loads(row[5]) if row[5] is not None else None,
+            "order_data": json.loads(row[6]) if row[6] is not None else None,
+        }
+
+    def start(self, key: str, uid: int | None = None) -> dict:
+        """Регистрирует очередную попытку обработки письма и возвращает его запись."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO messages (message_key, uid, stage, attempts, updated_at) VALUES (?, ?, 'fetched', 1, ?) "
+                "ON CONFLICT(message_key) DO UPDATE SET attempts = attempts + 1, "
+                "uid = COALESCE(excluded.uid, uid), updated_at = excluded.updated_at",
+                (key, uid, time.time()))
+            self.conn.commit()
+        return self.get(key)
+
+    def mark(self, key: str, stage: str, duration: float | None = None, **outputs):
+        """
+        Фиксирует пройденную стадию, её длительность и результаты (email_text, table_products, order_data).
+        На финальной стадии (written, failed) сохранённые результаты стираются.
+        """
+        columns = {"stage": stage, "updated_at": time.time()}
+        if stage in LEDGER_FINAL_STAGES:
+            columns.update(email_text=None, table_products=None, order_data=None)
+        else:
+            if "email_text" in outputs:
+                columns["email_text"] = outputs["email_text"]
+            for name in ("table_products", "order_data"):
+                if name in outputs:
+                    columns[name] = json.dumps(outputs[name], ensure_ascii=False, default=str)
+        with self.lock:
+            if duration is not None:
+                row = self.conn.execute("SELECT timings FROM messages WHERE message_key = ?", (key,)).fetchone()
+                timings = json.loads(row[0]) if row else {}
+                timings[stage] = round(duration, 3)
+                columns["timings"] = json.dumps(timings)
+            assignments = ", ".join(f"{name} = ?" for name in columns)
+            self.conn.execute(f"UPDATE messages SET {assignments} WHERE message_key = ?",
+                              (*columns.values(), key))
+            self.conn.commit()
+
+    def unfinished(self, max_attempts: int, older_than: float, limit: int) -> list:
+        """Незавершённые письма с оставшимися попытками, не обновлявшиеся older_than секунд: [(ключ, UID)]."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT message_key, uid FROM messages WHERE stage NOT IN ('written', 'failed') "
+                "AND attempts <= ? AND updated_at < ? AND uid IS NOT NULL ORDER BY updated_at LIMIT ?",
+                (max_attempts, time.time() - older_than, limit)).fetchall()
+
+    def max_uid(self) -> int | None:
+        with self.lock:
+            return self.conn.execute("SELECT MAX(uid) FROM messages").fetchone()[0]
+
+    def uid_validity(self) -> int | None:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM mailbox WHERE name = 'uidvalidity'").fetchone()
+        return row[0] if row else None
+
+    def set_uid_validity(self, value: int | None) -> bool:
+        """
+        Запоминает UIDVALIDITY ящика. Если он изменился, UID в журнале больше не указывают
+        на те же письма - они стираются (и повторно по ним письма не забираются).
+        Возвращает True, если UIDVALIDITY изменился.
+        """
+        if value is None:
+            return False
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM mailbox WHERE name = 'uidvalidity'").fetchone()
+            if row and row[0] == value:
+                return False
+            self.conn.execute("INSERT INTO mailbox (name, value) VALUES ('uidvalidity', ?) "
+                              "ON CONFLICT(name) DO UPDATE SET value = excluded.value", (value,))
+            if row:
+                self.conn.execute("UPDATE messages SET uid = NULL WHERE uid IS NOT NULL")
+            self.conn.commit()
+            return row is not None
+
+    def next_sequence(self, name: str) -> int:
+        """Следующее значение постоянного счётчика (переживает перезапуск)."""
+        with self.lock:
+            self.conn.execute("INSERT INTO sequences (name, value) VALUES (?, 1) "
+                              "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+            value = self.conn.execute("SELECT value FROM sequences WHERE name = ?", (name,)).fetchone()[0]
+            self.conn.commit()
+            return value
+
+
+def get_message_ledger(config: dict) -> MessageLedger:
+    global _message_ledger
+    with _ledger_init_lock:
+        if _message_ledger is None:
+            _message_ledger = MessageLedger(config.get("LEDGER_PATH", "ledger.db"))
+        return _message_ledger
+
+
+def message_key(msg, uid: int | None = None) -> str:
+    """Ключ письма в журнале: Message-ID, при его отсутствии - UID или хэш заголовков."""
+    message_id = (msg.get("Message-ID") or "").strip()
+    if message_id:
+        return message_id
+    if uid is not None:
+        return f"uid:{uid}"
+    headers = "|".join(str(msg.get(name, "")) for name in ("Date", "From", "Subject"))
+    return "hdr:" + hashlib.sha256(headers.encode("utf-8", errors="ignore")).hexdigest()
+
+
+def stage_reached(record: dict | None, stage: str) -> bool:
+    if not record or record["stage"] not in LEDGER_STAGES:
+        return False
+    return LEDGER_STAGES.index(record["stage"]) >= LEDGER_STAGES.index(stage)
+
+
+def ledger_should_skip(record: dict | None, config: dict) -> bool:
+    """Письмо уже записано, признано необрабатываемым или исчерпало попытки (LEDGER_MAX_ATTEMPTS)."""
+    if not record:
+        return False
+    if record["stage"] in LEDGER_FINAL_STAGES:
+        return True
+    return record["attempts"] > config.get("LEDGER_MAX_ATTEMPTS", 3)
+
+
+def extract_with_ledger(msg, key: str, config: dict) -> tuple:
+    """build_email_text с сохранением результата в журнал; повторно вложения не разбираются."""
+    ledger = get_message_ledger(config)
+    record = ledger.get(key)
+    if stage_reached(record, "extracted"):
+        logging.info(f"Письмо {key}: текст и вложения восстановлены из журнала.")
+        return record["email_text"], record["table_products"] or []
+    started = time.monotonic()
+    email_text, table_products = build_email_text(msg, config)
+    if not email_text:
+        ledger.mark(key, "failed", time.monotonic() - started)
+        return email_text, table_products
+    ledger.mark(key, "extracted", time.monotonic() - started,
+                email_text=email_text, table_products=table_products)
+    return email_text, table_products
+
+
+def analyze_with_ledger(email_text: str, table_products: list, key: str, config: dict) -> dict:
+    """
+    analyze_order с сохранением данных заказа в журнал; повторно GPT не вызывается.
+    Если GPT недоступен, письмо остаётся на стадии extracted и будет обработано повторно
+    (не больше LEDGER_MAX_ATTEMPTS раз); failed ставится, только если ответ GPT пустой или не разобран.
+    """
+    ledger = get_message_ledger(config)
+    record = ledger.get(key)
+    if stage_reached(record, "analyzed") and record["order_data"]:
+        logging.info(f"Письмо {key}: данные заказа восстановлены из журнала.")
+        order_data = record["order_data"]
+        order_data["email_text"] = email_text
+        return order_data
+    started = time.monotonic()
+    try:
+        order_data = analyze_order(email_text, table_products, config)
+    except GPTUnavailableError as e:
+        logging.warning(f"Письмо {key}: GPT недоступен ({e}), письмо будет обработано повторно.")
+        return {}
+    if not order_data:
+        ledger.mark(key, "failed", time.monotonic() - started)
         return {}
+    stored = {name: value for name, value in order_data.items() if name != "email_text"}
+    ledger.mark(key, "analyzed", time.monotonic() - started, order_data=stored)
+    return order_data
+
+
+# =============================
+# Асинхронный конвейер: письма → вложения → GPT → сопоставление → XML
+# =============================
+# Между стадиями - ограниченные очереди, поэтому медленная стадия притормаживает получение писем.
+# Каждая запись конвейера - словарь с порядковым номером seq; упавшая запись помечается failed
+# и всё равно доходит до записи XML, чтобы не блокировать порядок вывода.
+# Стадии и их результаты сохраняются в журнал писем, уже записанные письма в конвейер не попадают.
+async def _fetch_retries(config: dict, ledger: MessageLedger, state: dict) -> list:
+    """
+    Письма, не дошедшие до записи (сбой GPT, падение процесса), забираются повторно по UID:
+    новые письма идут по возрастанию UID, и сами они в выборку уже не попадут.
+    """
+    unfinished = await asyncio.to_thread(
+        ledger.unfinished, config.get("LEDGER_MAX_ATTEMPTS", 3), config.get("LEDGER_RETRY_DELAY", 60),
+        config.get("PIPELINE_FETCH_BATCH", 20))
+    uids = [uid for key, uid in unfinished if key not in state["in_flight"]]
+    if not uids:
+        return []
+    logging.info(f"Повторная обработка незавершённых писем: UID {uids}")
+    return await asyncio.to_thread(fetch_emails_by_uid, config, uids, state["uid_validity"])
+
+
+async def _pipeline_fetcher(config: dict, out_queue: asyncio.Queue, state: dict):
+    poll_interval = config.get("PIPELINE_POLL_INTERVAL", 30)
+    ledger = get_message_ledger(config)
+    while True:
+        try:
+            uid_validity, new_emails = await asyncio.to_thread(
+                fetch_new_emails, config, state["last_uid"], state["uid_validity"])
+            if uid_validity != state["uid_validity"]:
+                if await asyncio.to_thread(ledger.set_uid_validity, uid_validity):
+                    # Ящик перенумерован: прежний последний UID относится к старой нумерации
+                    state["last_uid"] = None
+                state["uid_validity"] = uid_validity
+            new_emails = await _fetch_retries(config, ledger, state) + new_emails
+        except Exception as e:
+            logging.error(f"Ошибка подключения или чтения почты: {e}", exc_info=True)
+            new_emails = []
+
+        for uid, msg in new_emails:
+            state["last_uid"] = max(uid, state["last_uid"] or 0)
+            key = message_key(msg, uid)
+            if key in state["in_flight"]:
+                continue
+            record = await asyncio.to_thread(ledger.get, key)
+            if ledger_should_skip(record, config):
+                logging.info(f"Письмо UID {uid} уже обработано, пропускаем его.")
+                continue
+            await asyncio.to_thread(ledger.start, key, uid)
+            state["in_flight"].add(key)
+            state["next_seq"] += 1
+            logging.info(f"Письмо UID {uid} поставлено в конвейер (№ {state['next_seq']}).")
+            await out_queue.put({"seq": state["next_seq"], "uid": uid, "key": key, "msg": msg, "failed": False})
+
+        if not new_emails:
+            logging.info("Новых писем не найдено. Ожидание...")
+        await asyncio.sleep(poll_interval)
+
+
+async def _pipeline_stage(name: str, handler, in_queue: asyncio.Queue, out_queue: asyncio.Queue):
+    while True:
+        item = await in_queue.get()
+        if not item["failed"]:
+            started = time.monotonic()
+            try:
+                await handler(item)
+                logging.info(f"Стадия '{name}' для письма UID {item['uid']}: {time.monotonic() - started:.2f} с")
+            except Exception as e:
+                logging.error(f"Стадия '{name}' для письма UID {item['uid']} завершилась ошибкой: {e}",
+                              exc_info=True)
+                item["failed"] = True
+        await out_queue.put(item)
+        in_queue.task_done()
+
+
+async def _extract_handler(item: dict, config: dict):
+    item["email_text"], item["table_products"] = await asyncio.to_thread(
+        extract_with_ledger, item["msg"], item["key"], config)
+    if not item["email_text"]:
+        item["failed"] = True
+
+
+async def _analyze_handler(item: dict, config: dict):
+    # Частоту запросов к GPT ограничивает token bucket внутри yandex_gpt_request
+    item["order_data"] = await asyncio.to_thread(analyze_with_ledger, item["email_text"], item["table_products"],
+                                                 item["key"], config)
+    if not item["order_data"]:
+        item["failed"] = True
+        return
+    item["order_data"]["email_msg"] = item["msg"]
+
+
+async def _match_handler(item: dict, nomenclature_data: list):
+    item["matched_products"] = await asyncio.to_thread(match_order_products, item["order_data"], nomenclature_data)
+
+
+async def _pipeline_writer(config: dict, nomenclature_data: list, in_queue: asyncio.Queue, state: dict):
+    """
+    Пишет XML строго в порядке получения писем: готовые раньше времени записи ждут в буфере.
+    Письмо, уже записанное по журналу, повторно не пишется.
+    """
+    ledger = get_message_ledger(config)
+    waiting = {}
+    next_to_write = 1
+    while True:
+        item = await in_queue.get()
+        waiting[item["seq"]] = item
+        while next_to_write in waiting:
+            ready = waiting.pop(next_to_write)
+            next_to_write += 1
+            state["in_flight"].discard(ready["key"])
+            if ready["failed"]:
+                logging.error(f"Письмо UID {ready['uid']} не обработано, XML не формируется.")
+                continue
+            record = await asyncio.to_thread(ledger.get, ready["key"])
+            if record and record["stage"] == "written":
+                logging.info(f"Письмо UID {ready['uid']} уже обработано, пропускаем его.")
+                continue
+            try:
+                started = time.monotonic()
+                await asyncio.to_thread(generate_order_xml, ready["order_data"], config, nomenclature_data,
+                                        ready["matched_products"])
+                await asyncio.to_thread(ledger.mark, ready["key"], "written", time.monotonic() - started)
+                logging.info(f"Обработка заказа из письма UID {ready['uid']} завершена.")
+            except OrderSaveError as e:
+                logging.error(f"Заказ из письма UID {ready['uid']} не записан ({e}), письмо будет обработано повторно.")
+            except Exception as e:
+                logging.error(f"Ошибка записи заказа из письма UID {ready['uid']}: {e}", exc_info=True)
+        in_queue.task_done()
+
+
+async def run_async_pipeline(config: dict, nomenclature_data: list):
+    """
+    Конвейерная обработка: несколько писем одновременно находятся на разных стадиях.
+    Число воркеров стадий и размер очередей берутся из конфига.
+    """
+    extract_workers = config.get("PIPELINE_EXTRACT_WORKERS", 2)
+    gpt_workers = config.get("GPT_MAX_CONCURRENCY", 4)
+    match_workers = config.get("PIPELINE_MATCH_WORKERS", 2)
+    queue_size = config.get("PIPELINE_QUEUE_SIZE", 8)
+
+    # asyncio.to_thread использует пул по умолчанию - расширяем его под все стадии сразу
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=extract_workers + gpt_workers + match_workers + 2,
+                           thread_name_prefix="pipeline"))
+
+    fetched, extracted, analyzed, matched = (asyncio.Queue(maxsize=queue_size) for _ in range(4))
+    # После перезапуска продолжаем с последнего UID из журнала, а не только с последнего письма.
+    # При смене UIDVALIDITY журнал стирает старые UID, поэтому max_uid относится к текущей нумерации
+    ledger = get_message_ledger(config)
+    state = {"last_uid": ledger.max_uid(), "uid_validity": ledger.uid_validity(), "next_seq": 0, "in_flight": set()}
+
+    tasks = [asyncio.create_task(_pipeline_fetcher(config, fetched, state))]
+    tasks += [asyncio.create_task(_pipeline_stage("вложения", functools.partial(_extract_handler, config=config),
+                                                  fetched, extracted)) for _ in range(extract_workers)]
+    tasks += [asyncio.create_task(_pipeline_stage("GPT", functools.partial(_analyze_handler, config=config),
+                                                  extracted, analyzed)) for _ in range(gpt_workers)]
+    tasks += [asyncio.create_task(_pipeline_stage("сопоставление",
+                                                  functools.partial(_match_handler, nomenclature_data=nomenclature_data),
+                                                  analyzed, matched)) for _ in range(match_workers)]
+    tasks.append(asyncio.create_task(_pipeline_writer(config, nomenclature_data, matched, state)))
+    await asyncio.gather(*tasks)
+
+
+# =============================
+# Сервис сопоставления номенклатуры (HTTP на localhost)
+# =============================
+# Запуск: python main.py --serve-matching. Номенклатура загружается один раз, индекс разбирается
+# до запуска воркеров (при fork воркеры получают его готовым). Одновременные запросы собираются
+# в микропакеты и уходят в пул процессов.
+#   POST /match        {"name": "..."}        -> {"result": {...}, "elapsed_ms": ...}
+#   POST /match/batch  {"names": ["...", ...]} -> {"results": [...], "elapsed_ms": ...}
+#   GET  /health
+_service_nomenclature = None
+
+
+def _init_matching_worker(worker_config: dict):
+    """Инициализатор воркера сервиса: при spawn модуль импортирован заново, конфиг и номенклатуру грузим сами."""
+    global _service_nomenclature, logs
+    if not config:
+        config.update(worker_config)
+        logging.basicConfig(level=logging.WARNING, format=log_format)
+        load_rules(config)
+    logs = 1 if config.get("MATCH_SERVICE_VERBOSE_LOGS") else 0
+    if _service_nomenclature is None:
+        _service_nomenclature = load_nomenclature(config.get("NOMENCLATURE_PATH", r"C:\1s\refs\nomenclature.txt"))
+
+
+def match_names_batch(names: list) -> list:
+    """Сопоставляет пакет наименований в воркере. Выполняется в пуле процессов."""
+    results = []
+    for name in names:
+        started = time.perf_counter()
+        matched_item = find_best_match(name, _service_nomenclature or [])
+        result = {"name": name, "matched": matched_item is not None, "code": "", "full_name": ""}
+        if matched_item:
+            result["code"] = matched_item.get('\ufeffКод') or matched_item.get('Код', '')
+            result["full_name"] = matched_item.get("Полное наименование", "")
+        result["match_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        results.append(result)
+    return results
+
+
+class MatchBatcher:
+    """
+    Собирает наименования из одновременных запросов в пакеты: до MATCH_BATCH_SIZE штук
+    или сколько успело прийти за MATCH_BATCH_WAIT_MS. Пока все воркеры заняты, новые пакеты
+    не отправляются, и очередь сама собирается в более крупные пакеты.
+    Если воркер пула упал (BrokenExecutor), пул пересоздаётся через pool_factory,
+    а пакет отправляется ещё раз - один раз.
+    """
+
+    def __init__(self, pool_factory, workers: int, batch_size: int, wait_seconds: float):
+        self.pool_factory = pool_factory
+        self.pool = pool_factory()
+        self.pool_lock = threading.Lock()
+        self.batch_size = batch_size
+        self.wait_seconds = wait_seconds
+        self.queue = Queue()
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        threading.Thread(target=self._run, name="match-batcher", daemon=True).start()
+
+    def submit(self, name: str) -> Future:
+        future = Future()
+        self.queue.put((name, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.wait_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Empty:
+                    break
+            self.slots.acquire()
+            self._dispatch(batch)
+
+    def _replace_broken_pool(self, broken_pool):
+        with self.pool_lock:
+            if self.pool is not broken_pool:
+                return  # пул уже пересоздан другим пакетом
+            logging.warning("Пул воркеров сопоставления сломан (воркер упал), пул пересоздаётся.")
+            self.pool = self.pool_factory()
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _dispatch(self, batch: list, retried: bool = False):
+        pool = self.pool
+
+        def fail(error):
+            if isinstance(error, BrokenExecutor) and not retried:
+                # Слот остаётся занятым: его освободит повторная отправка
+                self._replace_broken_pool(pool)
+                self._dispatch(batch, retried=True)
+                return
+            self.slots.release()
+            for _, future in batch:
+                future.set_exception(error)
+
+        def done(pool_future):
+            try:
+                results = pool_future.result()
+            except Exception as e:
+                fail(e)
+                return
+            self.slots.release()
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+        try:
+            pool_future = pool.submit(match_names_batch, [name for name, _ in batch])
+        except Exception as e:
+            fail(e)
+            return
+        pool_future.add_done_callback(done)
+
+
+class MatchRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive: клиенты шлют тысячи запросов по одному соединению
+    disable_nagle_algorithm = True  # заголовки и тело уходят разными пакетами - без TCP_NODELAY ждём delayed ACK
+    batcher = None
+    timeout_seconds = 30
+    max_batch = 1000
+
+    def _send_json(self, status: int, data: dict):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "nomenclature": len(_service_nomenclature or [])})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        started = time.perf_counter()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/match" and isinstance(request.get("name"), str):
+                names = [request["name"]]
+            elif self.path == "/match/batch" and isinstance(request.get("names"), list):
+                names = [str(name) for name in request["names"]]
+            else:
+                self._send_json(400 if self.path in ("/match", "/match/batch") else 404,
+                                {"error": "ожидается {\"name\": ...} для /match или {\"names\": [...]} для /match/batch"})
+                return
+        except (ValueError, AttributeError) as e:
+            self._send_json(400, {"error": f"некорректный запрос: {e}"})
+            return
+        if len(names) > self.max_batch:
+            self._send_json(413, {"error": f"не больше {self.max_batch} наименований в запросе"})
+            return
+
+        futures = [self.batcher.submit(name) for name in names]
+        try:
+            results = [future.result(timeout=self.timeout_seconds) for future in futures]
+        except TimeoutError:
+            self._send_json(504, {"error": "превышено время сопоставления"})
+            return
+        except Exception as e:
+            logging.error(f"Ошибка сопоставления: {e}", exc_info=True)
+            self._send_json(500, {"error": str(e)})
+            return
+
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 3)
+        logging.debug(f"{self.path}: {len(names)} наименований за {elapsed_ms} мс")
+        if self.path == "/match":
+            self._send_json(200, {"result": results[0], "elapsed_ms": elapsed_ms})
+        else:
+            self._send_json(200, {"results": results, "elapsed_ms": elapsed_ms})
+
+    def log_message(self, format, *args):
+        logging.debug("HTTP %s - %s", self.address_string(), format % args)
+
+
+def serve_matching(config: dict):
+    """Долгоживущий сервис сопоставления наименований с номенклатурой."""
+    global _service_nomenclature, logs
+    logs = 1 if config.get("MATCH_SERVICE_VERBOSE_LOGS") else 0
+    started = time.perf_counter()
+    _service_nomenclature = load_nomenclature(config.get("NOMENCLATURE_PATH", r"C:\1s\refs\nomenclature.txt"))
+    get_nomenclature_index(_service_nomenclature).warm()
+    logging.info(f"Индекс номенклатуры построен за {time.perf_counter() - started:.2f} с.")
+
+    workers = config.get("MATCH_SERVICE_WORKERS", os.cpu_count() or 2)
+    pool_factory = functools.partial(ProcessPoolExecutor, max_workers=workers, initializer=_init_matching_worker,
+                                     initargs=(dict(config),))
+    MatchRequestHandler.batcher = MatchBatcher(pool_factory, workers, config.get("MATCH_BATCH_SIZE", 64),
+                                               config.get("MATCH_BATCH_WAIT_MS", 2) / 1000)
+    MatchRequestHandler.timeout_seconds = config.get("MATCH_SERVICE_TIMEOUT", 30)
+    MatchRequestHandler.max_batch = config.get("MATCH_SERVICE_MAX_BATCH", 1000)
+
+    host = config.get("MATCH_SERVICE_HOST", "127.0.0.1")
+    port = config.get("MATCH_SERVICE_PORT", 8765)
+    server = ThreadingHTTPServer((host, port), MatchRequestHandler)
+    server.daemon_threads = True
+    logging.info(f"Сервис сопоставления запущен на http://{host}:{port} (воркеров: {workers}).")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        MatchRequestHandler.batcher.pool.shutdown(cancel_futures=True)
+
 
 # =============================
 # Основная функция обработки заказов
 # =============================
 def main():
-    global last_email_hash
-
     # --- ЗАГРУЗКА НОМЕНКЛАТУРЫ ПРИ СТАРТЕ ---
     logging.info("Загрузка номенклатуры...")
     nomenclature_file_path = config.get("NOMENCLATURE_PATH", r"C:\1s\refs\nomenclature.txt")
@@ -1035,51 +3651,60 @@ def main():
 
     logging.info("Запуск обработки заказов...")
     logging.info(f"Версия {config["VERSION"]}")
+
+    if config.get("PIPELINE_MODE") == "async":
+        logging.info("Включён асинхронный конвейер обработки писем.")
+        asyncio.run(run_async_pipeline(config, nomenclature_data))
+        return
+
+    ledger = get_message_ledger(config)
     while True:
         try:
-            email_text, msg = get_email_text_with_attachments(config)
-            if not email_text:
+            logging.info("Подключаюсь к IMAP для получения последнего письма...")
+            uid_validity, new_emails = fetch_new_emails(config)
+            ledger.set_uid_validity(uid_validity)
+            if not new_emails:
                 logging.info("Новых писем не найдено. Ожидание...")
                 time.sleep(30)
                 continue
 
-            current_hash = hashlib.md5(email_text.encode("utf-8")).hexdigest()
-            if last_email_hash is not None and current_hash == last_email_hash:
+            uid, msg = new_emails[0]
+            key = message_key(msg, uid)
+            if ledger_should_skip(ledger.get(key), config):
                 logging.info("Письмо уже обработано, пропускаем его. Ожидание...")
                 time.sleep(30)
                 continue
-            last_email_hash = current_hash
+            ledger.start(key, uid)
+
+            email_text, table_products = extract_with_ledger(msg, key, config)
+            if not email_text:
+                time.sleep(30)
+                continue
 
-            logging.info("Первые 5000 символов письма:\n%s", email_text[:5000])
-            logging.info("Письмо получено. Анализирую письмо через GPT...")
-            order_data = analyze_email_with_gpt(email_text, config)
+            order_data = analyze_with_ledger(email_text, table_products, key, config)
             if not order_data:
-                logging.error("Не удалось извлечь данные заказа из письма.")
                 time.sleep(30)
                 continue
-            logging.info("Извлеченные данные заказа:\n%s", json.dumps(order_data, ensure_ascii=False, indent=2))
-
-            if not order_data.get("order", {}).get("products"):
-                logging.info("Список товаров пуст, пробую извлечь товары с многоступенчатым методом.")
-                fallback_products = extract_products_multifallback(email_text)
-                logging.info("Многоступенчатое извлечение товаров вернуло: %s", fallback_products)
-                if fallback_products:
-                    order_data.setdefault("order", {})["products"] = fallback_products
-                else:
-                    logging.warning("Не удалось извлечь товары ни одним методом.")
 
             order_data["email_msg"] = msg
-            order_data["email_text"] = email_text
 
             # --- ВЫЗОВ ФУНКЦИИ С ПЕРЕДАЧЕЙ НОМЕНКЛАТУРЫ ---
+            started = time.monotonic()
             generate_order_xml(order_data, config, nomenclature_data)
+            ledger.mark(key, "written", time.monotonic() - started)
             # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
             logging.info("Обработка заказа завершена.")
+        except OrderSaveError as e:
+            logging.error(f"Заказ не записан ({e}), письмо будет обработано повторно.")
         except Exception as e:
             logging.error(f"Общая ошибка в обработке: {e}", exc_info=True)
         logging.info("Ожидание новых писем...")
         time.sleep(30)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    init()
+    if "--serve-matching" in sys.argv:
+        serve_matching(config)
+    else:
+        main()
@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Тесты работают во временной папке со своим config.json
+WORKDIR = tempfile.mkdtemp(prefix="order_tests_")
+with open(os.path.join(WORKDIR, "config.json"), "w", encoding="utf-8") as f:
+    json.dump({
+        "REGEX_PATH": os.path.join(ROOT, "regex.json"),
+        "PARAMETERS_PATH": os.path.join(ROOT, "parameters.json"),
+        "SYNONYMS_PATH": os.path.join(ROOT, "synonyms_data.json"),
+        "LOGS_FOLDER": os.path.join(WORKDIR, "logs"),
+        "ORDER_XML_FOLDER": os.path.join(WORKDIR, "docs"),
+        "ARCHIVE_FOLDER": os.path.join(WORKDIR, "archive"),
+        "VERSION": "test",
+    }, f)
+os.chdir(WORKDIR)
+
+import main  # noqa: E402
+
+main.init(os.path.join(WORKDIR, "config.json"))
+
+
+@pytest.fixture
+def attachment_pools():
+    """Останавливает пулы воркеров вложений, созданные тестом."""
+    yield
+    for name in ("_attachment_thread_pool", "_attachment_process_pool"):
+        pool = getattr(main, name)
+        setattr(main, name, None)
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+@pytest.fixture
+def order_config(tmp_path, monkeypatch):
+    """Папки заказов и архива во временной папке, свежие журнал и индекс дублей."""
+    monkeypatch.setattr(main, "_message_ledger", None)
+    monkeypatch.setattr(main, "_order_dedup_index", None)
+    config = {"ORDER_XML_FOLDER": str(tmp_path / "docs"), "ARCHIVE_FOLDER": str(tmp_path / "archive"),
+              "LEDGER_PATH": str(tmp_path / "ledger.db")}
+    yield config
+    for name in ("_message_ledger", "_order_dedup_index"):
+        if getattr(main, name) is not None:
+            getattr(main, name).conn.close()
@@ -0,0 +1,62 @@
+import io
+
+import pytest
+
+import main
+
+openpyxl = pytest.importorskip("openpyxl")
+
+
+def _xlsx(rows: list) -> bytes:
+    workbook = openpyxl.Workbook()
+    for row in [["Наименование", "Кол-во", "Ед.изм."]] + rows:
+        workbook.active.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def _email_text(rows: list, body: str = "Добрый день, заявка во вложении.") -> tuple:
+    attachments_text, products = main.extract_attachments_text(
+        [("заявка.xlsx", _xlsx(rows))], {"ATTACHMENT_CACHE_FOLDER": ""})
+    return f"=== ТЕКСТ ПИСЬМА ===\n{body}\n\n=== ВЛОЖЕНИЯ ===\n{attachments_text.strip()}", products
+
+
+@pytest.fixture
+def gpt_calls(monkeypatch, attachment_pools):
+    calls = {"include_products": [], "products_text": []}
+
+    def analyze(email_text, config, include_products=True):
+        calls["include_products"].append(include_products)
+        return {"company": {"INN": "7701234567"}, "order": {"products": []}}
+
+    def extract_products(email_text, *args, **kwargs):
+        calls["products_text"].append(email_text)
+        return [{"name": "Фланец Ду50", "code": "", "quantity": 1, "sum": 0.0}]
+
+    monkeypatch.setattr(main, "analyze_email_with_gpt", analyze)
+    monkeypatch.setattr(main, "gpt_extract_products", extract_products)
+    return calls
+
+
+def test_tables_covering_the_order_skip_gpt_products(gpt_calls):
+    email_text, table_products = _email_text([["Труба 57х3,5", "10", "м"], ["Отвод 90", "5 шт", "шт"]])
+    order_data = main.analyze_order(email_text, table_products, {})
+    assert gpt_calls["include_products"] == [False]
+    assert gpt_calls["products_text"] == []
+    assert [p["name"] for p in order_data["order"]["products"]] == ["Труба 57х3,5", "Отвод 90"]
+
+
+def test_unparsed_table_row_goes_to_gpt_and_is_merged(gpt_calls):
+    email_text, table_products = _email_text([["Труба 57х3,5", "10", "м"],
+                                              ["Фланец Ду50", "по согласованию", "шт"]])
+    order_data = main.analyze_order(email_text, table_products, {})
+    assert "Фланец Ду50\tпо согласованию" in gpt_calls["products_text"][0]
+    assert [p["name"] for p in order_data["order"]["products"]] == ["Труба 57х3,5", "Фланец Ду50"]
+
+
+def test_products_in_body_are_not_dropped(gpt_calls):
+    email_text, table_products = _email_text([["Труба 57х3,5", "10", "м"]],
+                                             body="Заявка во вложении, и ещё добавьте:\nОтвод 90 - 5 шт")
+    main.analyze_order(email_text, table_products, {})
+    assert len(gpt_calls["products_text"]) == 1
@@ -0,0 +1,70 @@
+import io
+import tarfile
+import zipfile
+
+import main
+
+MB = 1024 * 1024
+
+
+def _zip(files: dict) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _tar(files: dict) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def _names(jobs: list) -> list:
+    return [name for name, _ in jobs]
+
+
+def test_supported_members_are_extracted():
+    payload = _zip({"заявка.txt": "Труба 57х3,5 - 10 м".encode("utf-8"), "схема.bin": b"\x00" * 10})
+    jobs = main.expand_archive("order.zip", payload, {})
+    assert jobs == [("order.zip/заявка.txt", "Труба 57х3,5 - 10 м".encode("utf-8")),
+                    ("order.zip/схема.bin", b"")]
+
+
+def test_nested_archives_are_expanded_up_to_max_depth():
+    inner = _tar({"заявка.txt": b"order"})
+    payload = _zip({"inner.tar.gz": inner})
+    jobs = main.expand_archive("outer.zip", payload, {"ARCHIVE_MAX_DEPTH": 3})
+    assert jobs == [("outer.zip/inner.tar.gz/заявка.txt", b"order")]
+
+    jobs = main.expand_archive("outer.zip", payload, {"ARCHIVE_MAX_DEPTH": 1})
+    assert jobs == [("outer.zip", None)]
+
+
+def test_member_count_limit():
+    payload = _zip({f"file{i}.txt": b"x" for i in range(5)})
+    jobs = main.expand_archive("many.zip", payload, {"ARCHIVE_MAX_MEMBERS": 3})
+    assert _names(jobs) == ["many.zip/file0.txt", "many.zip/file1.txt", "many.zip/file2.txt", "many.zip"]
+    assert jobs[-1][1] is None
+
+
+def test_skipped_members_count_toward_total_size():
+    # Неподдерживаемые файлы не распаковываются, но их объём всё равно идёт в лимит
+    for payload, name in ((_zip({"a.bin": b"\x00" * (MB // 2), "b.bin": b"\x00" * MB, "c.txt": b"x"}), "big.zip"),
+                          (_tar({"a.bin": b"\x00" * (MB // 2), "b.bin": b"\x00" * MB, "c.txt": b"x"}), "big.tgz")):
+        jobs = main.expand_archive(name, payload, {"ARCHIVE_MAX_TOTAL_MB": 1})
+        assert _names(jobs) == [f"{name}/a.bin", name]
+        assert jobs[-1][1] is None
+
+
+def test_extracted_size_limit_spans_nested_archives():
+    inner = _zip({"part.txt": b"y" * (MB // 2 + 1)})
+    payload = _zip({"one.zip": inner, "two.zip": inner})
+    jobs = main.expand_archive("outer.zip", payload, {"ARCHIVE_MAX_TOTAL_MB": 1})
+    assert jobs[0] == ("outer.zip/one.zip/part.txt", b"y" * (MB // 2 + 1))
+    assert jobs[1:] == [("outer.zip/two.zip", None)]
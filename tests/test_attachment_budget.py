@@ -0,0 +1,78 @@
+import io
+import random
+
+import pytest
+
+import main
+
+openpyxl = pytest.importorskip("openpyxl")
+
+
+def _truncate(text: str, budget: int) -> str:
+    # Так же, как build_email_text обрезает итоговый текст письма
+    text = text.strip()
+    if len(text) > budget:
+        return text[:budget] + "\n...[текст обрезан из-за превышения лимита]"
+    return text
+
+
+def _random_words(rng: random.Random, count: int) -> str:
+    words = ["труба", "отвод", "фланец", "заказ", "счёт", "ИНН", "поставка", "  ", "\n", "\t"]
+    return " ".join(rng.choice(words) for _ in range(count))
+
+
+def _random_xlsx(rng: random.Random) -> bytes:
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["Спецификация"])
+    if rng.random() < 0.7:
+        sheet.append(["Наименование", "Кол-во", "Ед.изм."])
+        for i in range(rng.randint(1, 15)):
+            quantity = rng.choice([str(rng.randint(1, 100)), f"{rng.randint(1, 9)} шт", "по запросу"])
+            sheet.append([f"Позиция {i}", quantity, "шт"])
+    else:
+        for _ in range(rng.randint(1, 30)):
+            sheet.append([_random_words(rng, rng.randint(1, 8)), rng.randint(1, 100)])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def _random_jobs(rng: random.Random) -> list:
+    jobs = []
+    for i in range(rng.randint(0, 6)):
+        kind = rng.random()
+        if kind < 0.5:
+            jobs.append((f"file{i}.txt", _random_words(rng, rng.randint(0, 400)).encode("utf-8")))
+        elif kind < 0.8:
+            jobs.append((f"table{i}.xlsx", _random_xlsx(rng)))
+        elif kind < 0.9:
+            jobs.append((f"unknown{i}.bin", b"\x00\x01"))
+        else:
+            jobs.append((f"broken{i}.txt", None))
+    return jobs
+
+
+@pytest.fixture
+def attachment_config(tmp_path, attachment_pools):
+    return {"ATTACHMENT_TIMEOUT": 30, "ATTACHMENT_CACHE_FOLDER": str(tmp_path / "cache"),
+            "ATTACHMENT_THREAD_WORKERS": 4}
+
+
+def test_budget_gives_same_truncated_text_and_products(attachment_config):
+    rng = random.Random(20240613)
+    for _ in range(60):
+        jobs = _random_jobs(rng)
+        budget = rng.choice([0, 1, 10, 100, 500, 2000, 10 ** 6])
+        no_cache = dict(attachment_config, ATTACHMENT_CACHE_FOLDER="")
+
+        full_text, full_products = main.extract_attachments_text(jobs, no_cache)
+        text, products = main.extract_attachments_text(jobs, no_cache, char_budget=budget)
+        assert _truncate(text, budget) == _truncate(full_text, budget)
+        assert products == full_products
+
+        # Второй проход идёт через кэш, в том числе через неполные (обрезанные по лимиту) записи
+        for _ in range(2):
+            text, products = main.extract_attachments_text(jobs, attachment_config, char_budget=budget)
+            assert _truncate(text, budget) == _truncate(full_text, budget)
+            assert products == full_products
@@ -0,0 +1,58 @@
+import json
+import logging
+import re
+
+import pytest
+
+import main
+
+requests = pytest.importorskip("requests")
+
+SPEC_LINES = [f"Отвод 90 {i % 3 + 1}" if i % 4 else "Труба 57х3,5 10" for i in range(40)]
+
+
+@pytest.fixture
+def chunk_config(monkeypatch):
+    for key, value in {"GPT_CHUNK_TOKENS": 40, "GPT_MAX_CONCURRENCY": 2, "YANDEX_SA_API_KEY": "test",
+                       "YANDEX_GPT_MODEL_URI_PATTERN": "gpt://test/yandexgpt"}.items():
+        monkeypatch.setitem(main.config, key, value)
+
+
+def _gpt_answer(products: list) -> dict:
+    return {"result": {"alternatives": [{"message": {"role": "assistant",
+                                                     "text": json.dumps(products, ensure_ascii=False)}}]}}
+
+
+def _products_from_prompt(payload: dict) -> list:
+    chunk = payload["messages"][0]["text"].split("Текст письма:\n", 1)[1]
+    return [{"name": m.group(1), "code": "", "quantity": int(m.group(2)), "sum": 0.0}
+            for m in re.finditer(r"^(\D+?) (\d+)$", chunk, re.MULTILINE)]
+
+
+def test_repeated_rows_in_different_chunks_are_kept(chunk_config, monkeypatch):
+    monkeypatch.setattr(main, "yandex_gpt_request",
+                        lambda payload, config, headers: _gpt_answer(_products_from_prompt(payload)))
+    products = main.gpt_extract_products_chunked("\n".join(SPEC_LINES))
+    assert [f"{p['name']} {p['quantity']}" for p in products] == SPEC_LINES
+
+
+def test_chunk_request_failure_raises(chunk_config, monkeypatch):
+    calls = []
+
+    def request(payload, config, headers):
+        calls.append(payload)
+        if len(calls) == 2:
+            raise requests.exceptions.ConnectionError("connection reset")
+        return _gpt_answer(_products_from_prompt(payload))
+
+    monkeypatch.setattr(main, "yandex_gpt_request", request)
+    with pytest.raises(main.GPTUnavailableError):
+        main.gpt_extract_products_chunked("\n".join(SPEC_LINES))
+
+
+def test_empty_chunk_is_logged_as_error(chunk_config, monkeypatch, caplog):
+    monkeypatch.setattr(main, "yandex_gpt_request", lambda payload, config, headers: _gpt_answer([]))
+    with caplog.at_level(logging.ERROR):
+        products = main.gpt_extract_products_chunked("Просим рассмотреть\n" * 30)
+    assert products == []
+    assert "не извлечено ни одной позиции" in caplog.text
@@ -0,0 +1,125 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main
+
+requests = pytest.importorskip("requests")
+
+GPT_RESPONSE = {"result": {"alternatives": [{"message": {"role": "assistant", "text": "{}"}}],
+                           "usage": {"inputTextTokens": "10", "completionTokens": "2"}}}
+
+
+class StubGPTServer:
+    """Локальный HTTP-сервер вместо Yandex GPT: отдаёт заранее заданные статусы по очереди."""
+
+    def __init__(self):
+        self.statuses = []
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stub.requests.append(json.loads(body))
+                status = stub.statuses.pop(0) if stub.statuses else 200
+                data = json.dumps(GPT_RESPONSE if status == 200 else {"error": status}).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/completion"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.closed = False
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.server.shutdown()
+            self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    server = StubGPTServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def gpt_config(stub_server, monkeypatch, tmp_path):
+    # Сессия общая на процесс - каждому тесту свежая
+    monkeypatch.setattr(main, "_gpt_session", None)
+    return {"YANDEX_GPT_API_ENDPOINT": stub_server.url, "GPT_CACHE_FOLDER": str(tmp_path / "gpt_cache"),
+            "GPT_MAX_RETRIES": 2,
+            "GPT_BACKOFF_BASE": 0.01, "GPT_BACKOFF_MAX": 0.05, "GPT_CONNECT_TIMEOUT": 2, "GPT_READ_TIMEOUT": 5}
+
+
+def _payload(text: str) -> dict:
+    return {"modelUri": "gpt://test/yandexgpt", "completionOptions": {"temperature": 0.1},
+            "messages": [{"role": "user", "text": text}]}
+
+
+def test_retries_server_errors_and_rate_limit(stub_server, gpt_config):
+    stub_server.statuses = [503, 429]
+    response = main.yandex_gpt_request(_payload("заказ"), gpt_config, {})
+    assert response == GPT_RESPONSE
+    assert len(stub_server.requests) == 3
+
+
+def test_successful_response_is_cached(stub_server, gpt_config):
+    first = main.yandex_gpt_request(_payload("кэш"), gpt_config, {})
+    second = main.yandex_gpt_request(_payload("кэш"), gpt_config, {})
+    assert first == second == GPT_RESPONSE
+    assert len(stub_server.requests) == 1
+
+
+def test_expired_response_is_requested_again(stub_server, gpt_config):
+    config = dict(gpt_config, GPT_CACHE_TTL=-1)
+    main.yandex_gpt_request(_payload("ttl"), config, {})
+    main.yandex_gpt_request(_payload("ttl"), config, {})
+    assert len(stub_server.requests) == 2
+
+
+def test_cache_hits_do_not_extend_ttl(tmp_path):
+    folder = str(tmp_path / "cache")
+    main.disk_cache_put(folder, "ab12", {"response": GPT_RESPONSE}, "test", 10 ** 6)
+    path = main._cache_path(folder, "ab12")
+    with open(path, encoding="utf-8") as f:
+        entry = json.load(f)
+    entry["created_at"] -= 100  # запись создана давно, но mtime свежий, как после попадания
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(entry, f)
+    assert main.disk_cache_get(folder, "ab12", "test", ttl=1000)["response"] == GPT_RESPONSE
+    assert main.disk_cache_get(folder, "ab12", "test", ttl=50) is None
+
+
+def test_client_error_is_not_retried(stub_server, gpt_config):
+    stub_server.statuses = [400]
+    with pytest.raises(requests.exceptions.HTTPError):
+        main.yandex_gpt_request(_payload("ошибка"), gpt_config, {})
+    assert len(stub_server.requests) == 1
+
+
+def test_gives_up_after_max_retries(stub_server, gpt_config):
+    stub_server.statuses = [503, 503, 503, 503]
+    with pytest.raises(requests.exceptions.HTTPError):
+        main.yandex_gpt_request(_payload("недоступен"), gpt_config, {})
+    assert len(stub_server.requests) == gpt_config["GPT_MAX_RETRIES"] + 1
+
+
+def test_unreachable_server_raises_connection_error(stub_server, gpt_config):
+    stub_server.close()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        main.yandex_gpt_request(_payload("сеть"), gpt_config, {})
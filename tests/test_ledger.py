@@ -0,0 +1,128 @@
+from email.message import EmailMessage
+
+import pytest
+
+import main
+
+
+def _message(number: int) -> bytes:
+    msg = EmailMessage()
+    msg["Message-ID"] = f"<order-{number}@client.ru>"
+    msg["Subject"] = f"Заявка {number}"
+    msg.set_content("Труба 57х3,5 - 10 м")
+    return msg.as_bytes()
+
+
+class FakeIMAP:
+    """INBOX в памяти: UIDVALIDITY и письма по UID задаются тестом."""
+    uid_validity = 1
+    messages = {}
+
+    def __init__(self, server):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def select(self, mailbox):
+        pass
+
+    def response(self, code):
+        return code, [str(FakeIMAP.uid_validity).encode()]
+
+    def uid(self, command, *args):
+        if command == "search":
+            return "OK", [b" ".join(str(uid).encode() for uid in sorted(FakeIMAP.messages))]
+        uid = int(args[0])
+        return "OK", [(b"RFC822", FakeIMAP.messages[uid])] if uid in FakeIMAP.messages else [None]
+
+    def logout(self):
+        pass
+
+
+@pytest.fixture
+def mailbox(monkeypatch, order_config):
+    monkeypatch.setattr(main.imaplib, "IMAP4_SSL", FakeIMAP)
+    monkeypatch.setattr(FakeIMAP, "uid_validity", 1)
+    monkeypatch.setattr(FakeIMAP, "messages", {uid: _message(uid) for uid in (1, 2, 3)})
+    return dict(order_config, IMAP_SERVER="imap.test", MAIL_USER="user", MAIL_PASSWORD="password")
+
+
+def test_extract_and_analyze_resume_from_ledger(order_config, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "build_email_text", lambda msg, config: calls.append("extract") or ("текст", []))
+    monkeypatch.setattr(main, "analyze_order",
+                        lambda text, products, config: calls.append("analyze") or {"order": {"products": []}})
+    ledger = main.get_message_ledger(order_config)
+    ledger.start("key", 1)
+
+    for _ in range(2):
+        email_text, table_products = main.extract_with_ledger(None, "key", order_config)
+        order_data = main.analyze_with_ledger(email_text, table_products, "key", order_config)
+    assert calls == ["extract", "analyze"]
+    assert order_data == {"order": {"products": []}, "email_text": "текст"}
+    assert ledger.get("key")["stage"] == "analyzed"
+
+
+def test_gpt_outage_leaves_message_for_retry(order_config, monkeypatch):
+    def unavailable(text, products, config):
+        raise main.GPTUnavailableError("503")
+
+    monkeypatch.setattr(main, "analyze_order", unavailable)
+    ledger = main.get_message_ledger(order_config)
+    ledger.start("key", 1)
+    ledger.mark("key", "extracted", email_text="текст", table_products=[])
+
+    assert main.analyze_with_ledger("текст", [], "key", order_config) == {}
+    record = ledger.get("key")
+    assert record["stage"] == "extracted"
+    assert not main.ledger_should_skip(record, order_config)
+
+
+def test_final_stages_are_skipped_and_drop_stored_results(order_config):
+    ledger = main.get_message_ledger(order_config)
+    ledger.start("key", 1)
+    ledger.mark("key", "analyzed", email_text="текст", table_products=[{"name": "Труба"}],
+                order_data={"order": {}})
+    ledger.mark("key", "written", 0.5)
+
+    record = ledger.get("key")
+    assert record["email_text"] is None and record["table_products"] is None and record["order_data"] is None
+    assert record["timings"] == {"written": 0.5}
+    assert main.ledger_should_skip(record, order_config)
+
+
+def test_attempts_limit_skips_message(order_config):
+    ledger = main.get_message_ledger(order_config)
+    for _ in range(3):
+        record = ledger.start("key", 1)
+    assert not main.ledger_should_skip(record, dict(order_config, LEDGER_MAX_ATTEMPTS=3))
+    record = ledger.start("key", 1)
+    assert main.ledger_should_skip(record, dict(order_config, LEDGER_MAX_ATTEMPTS=3))
+
+
+def test_fetch_resumes_after_last_uid(mailbox):
+    uid_validity, emails = main.fetch_new_emails(mailbox, 1, 1)
+    assert uid_validity == 1
+    assert [uid for uid, _ in emails] == [2, 3]
+    assert main.fetch_new_emails(mailbox)[1][0][0] == 3
+
+
+def test_uid_validity_change_resets_last_uid(mailbox):
+    ledger = main.get_message_ledger(mailbox)
+    assert not ledger.set_uid_validity(1)
+    ledger.start("<order-3@client.ru>", 3)
+    assert ledger.max_uid() == 3
+
+    # Сервер перенумеровал ящик: UID 3 теперь может быть любым письмом
+    FakeIMAP.uid_validity = 2
+    FakeIMAP.messages = {uid: _message(uid + 10) for uid in (1, 2)}
+    uid_validity, emails = main.fetch_new_emails(mailbox, 3, 1)
+    assert uid_validity == 2
+    assert [uid for uid, _ in emails] == [2]
+
+    assert ledger.set_uid_validity(2)
+    assert ledger.uid_validity() == 2
+    assert ledger.max_uid() is None
+    assert main.fetch_emails_by_uid(mailbox, [1], 1) == []
+    assert [uid for uid, _ in main.fetch_emails_by_uid(mailbox, [1], 2)] == [1]
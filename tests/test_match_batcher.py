@@ -0,0 +1,57 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import main
+
+
+class FakePool:
+    """Пул, который сразу выполняет пакет или падает, как пул с убитым воркером."""
+
+    def __init__(self, broken: bool):
+        self.broken = broken
+        self.shut_down = False
+        self.batches = []
+
+    def submit(self, fn, names):
+        self.batches.append(names)
+        future = Future()
+        if self.broken:
+            future.set_exception(BrokenProcessPool("воркер упал"))
+        else:
+            future.set_result([f"match:{name}" for name in names])
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+def _batcher(pools: list) -> main.MatchBatcher:
+    created = []
+
+    def factory():
+        created.append(pools[len(created)])
+        return created[-1]
+
+    return main.MatchBatcher(factory, workers=1, batch_size=2, wait_seconds=0.01)
+
+
+def test_broken_pool_is_replaced_and_batch_retried():
+    broken, healthy = FakePool(broken=True), FakePool(broken=False)
+    batcher = _batcher([broken, healthy])
+    futures = [batcher.submit("труба"), batcher.submit("отвод")]
+    assert [future.result(timeout=5) for future in futures] == ["match:труба", "match:отвод"]
+    assert batcher.pool is healthy and broken.shut_down
+    assert broken.batches == healthy.batches == [["труба", "отвод"]]
+    # Слот освобождён ровно один раз: новые пакеты продолжают отправляться
+    assert batcher.submit("фланец").result(timeout=5) == "match:фланец"
+
+
+def test_batch_is_retried_only_once():
+    pools = [FakePool(broken=True), FakePool(broken=True), FakePool(broken=False)]
+    batcher = _batcher(pools)
+    with pytest.raises(BrokenProcessPool):
+        batcher.submit("труба").result(timeout=5)
+    assert batcher.pool is pools[1]
+    assert batcher.submit("отвод").result(timeout=5) == "match:отвод"
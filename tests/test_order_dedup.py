@@ -0,0 +1,55 @@
+import errno
+import os
+
+import main
+
+ORDER = {"company": {"INN": "7701234567", "name": "ООО Ромашка"}, "order": {}}
+PRODUCTS = [{"code": "00-1", "name": "Труба 57х3,5", "quantity": 10}]
+
+
+def _archive_files(config) -> list:
+    return os.listdir(config["ARCHIVE_FOLDER"])
+
+
+def test_identical_order_is_archived_once(order_config):
+    main.generate_order_xml(ORDER, order_config, [], PRODUCTS)
+    os.remove(os.path.join(order_config["ARCHIVE_FOLDER"], _archive_files(order_config)[0]))
+    main.generate_order_xml(ORDER, order_config, [], PRODUCTS)
+    assert _archive_files(order_config) == []
+
+
+def test_failed_archive_write_is_not_remembered(order_config, monkeypatch):
+    replace = os.replace
+
+    def replace_without_archive(src, dst):
+        if os.path.dirname(dst) == order_config["ARCHIVE_FOLDER"]:
+            raise OSError(errno.EACCES, "Permission denied")
+        replace(src, dst)
+
+    monkeypatch.setattr(main.os, "replace", replace_without_archive)
+    main.generate_order_xml(ORDER, order_config, [], PRODUCTS)
+    assert _archive_files(order_config) == []
+
+    monkeypatch.setattr(main.os, "replace", replace)
+    main.generate_order_xml(ORDER, order_config, [], PRODUCTS)
+    assert len(_archive_files(order_config)) == 1
+
+
+def test_marker_files_are_migrated_once(order_config, tmp_path):
+    archive = order_config["ARCHIVE_FOLDER"]
+    os.makedirs(archive)
+    xml = "".join(main.iter_order_xml(ORDER, PRODUCTS))
+    marker = os.path.join(archive, f"order_{main._order_hash(xml).hex()}.marker")
+    open(marker, "w").close()
+    open(os.path.join(archive, "order_notahash.marker"), "w").close()
+
+    assert main.is_duplicate_order(xml, order_config)
+    assert sorted(os.listdir(archive)) == ["order_notahash.marker"]
+
+    # Повторный запуск: индекс берётся из SQLite, новые маркеры больше не читаются
+    main._order_dedup_index.conn.close()
+    main._order_dedup_index = None
+    open(os.path.join(archive, f"order_{'0' * 32}.marker"), "w").close()
+    assert main.is_duplicate_order(xml, order_config)
+    assert not main.is_duplicate_order("<Заказ/>", order_config)
+    assert bytes(16) not in main.get_order_dedup_index(order_config)
@@ -0,0 +1,79 @@
+import errno
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import main
+
+ORDER = {"company": {"INN": "7701234567", "name": 'ООО "Рога & Копыта" <опт>\x01'},
+         "order": {"contact_person": {"full_name": "Иван Петров", "phone": "+7 (999) 123-45-67"}}}
+PRODUCTS = [{"code": "00-1", "name": "Труба 57х3,5 <ГОСТ>", "quantity": 10}]
+
+
+def _save(config, products=PRODUCTS):
+    return main.generate_order_xml(ORDER, config, [], products)
+
+
+def test_values_are_escaped_and_invalid_chars_removed():
+    root = ET.fromstring("".join(main.iter_order_xml(ORDER, PRODUCTS)))
+    assert root.findtext("Контрагент/НаименованиеПолное") == 'ООО "Рога & Копыта" <опт>'
+    assert root.findtext("Товары/Товар/ПолноеНаименование") == "Труба 57х3,5 <ГОСТ>"
+    assert root.findtext("Контрагент/Телефон") == "+7 (999) 123-45-67"
+
+
+def test_order_and_archive_are_written_through_their_own_spool(order_config, monkeypatch):
+    replace = os.replace
+
+    def replace_on_same_volume(src, dst):
+        # Спул должен лежать рядом с папкой назначения, иначе на другом диске rename невозможен
+        if os.path.dirname(src) != os.path.dirname(dst) + "_spool":
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        replace(src, dst)
+
+    monkeypatch.setattr(main.os, "replace", replace_on_same_volume)
+    _save(order_config)
+    assert os.listdir(order_config["ORDER_XML_FOLDER"]) == ["zakaz.xml"]
+    assert len(os.listdir(order_config["ARCHIVE_FOLDER"])) == 1
+
+
+def test_failed_write_leaves_no_partial_file(order_config, monkeypatch):
+    def failing_replace(src, dst):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(main.os, "replace", failing_replace)
+    with pytest.raises(main.OrderSaveError):
+        _save(order_config)
+    spool = main.order_spool_folder(order_config, order_config["ORDER_XML_FOLDER"])
+    assert os.listdir(order_config["ORDER_XML_FOLDER"]) == []
+    assert os.listdir(spool) == []
+
+
+def test_unavailable_order_folder_raises(order_config, tmp_path):
+    (tmp_path / "file").write_text("")
+    config = dict(order_config, ORDER_XML_FOLDER=str(tmp_path / "file" / "docs"))
+    with pytest.raises(main.OrderSaveError):
+        _save(config)
+
+
+def test_filenames_do_not_overwrite_unprocessed_orders(order_config):
+    folder = order_config["ORDER_XML_FOLDER"]
+    os.makedirs(folder)
+    # Файл прежней схемы именования, ещё не забранный 1С
+    open(os.path.join(folder, "zakaz_2.xml"), "w").close()
+    for i in range(3):
+        _save(order_config, [dict(PRODUCTS[0], quantity=i + 1)])
+    names = sorted(os.listdir(folder))
+    assert names == ["zakaz.xml", "zakaz_1.xml", "zakaz_2.xml", "zakaz_3.xml"]
+    assert os.path.getsize(os.path.join(folder, "zakaz_2.xml")) == 0
+
+
+def test_processed_marker_clears_folder(order_config):
+    folder = order_config["ORDER_XML_FOLDER"]
+    _save(order_config)
+    _save(order_config, [dict(PRODUCTS[0], quantity=2)])
+    open(os.path.join(folder, "zakaz.processed.txt"), "w").close()
+    _save(order_config, [dict(PRODUCTS[0], quantity=3)])
+    assert sorted(os.listdir(folder)) == ["zakaz.processed.txt", "zakaz.xml"]
+    root = ET.parse(os.path.join(folder, "zakaz.xml")).getroot()
+    assert root.findtext("Товары/Товар/Количество") == "3"
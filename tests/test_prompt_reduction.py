@@ -0,0 +1,118 @@
+import main
+
+NOMENCLATURE = """Номенклатура
+
+Отвод 57х3
+шт
+4
+
+Кран шаровой
+шт
+2
+
+Электроды УОНИ
+кг
+15"""
+
+FORWARDED_ORDER = f"""=== ТЕКСТ ПИСЬМА ===
+Добрый день! Пересылаю заказ клиента, прошу обработать.
+
+С уважением,
+Иван Петров
+менеджер отдела продаж
+
+---------- Forwarded message ---------
+От: Снабжение <zakaz@client.ru>
+Тема: Заявка
+
+Здравствуйте, просим выставить счёт.
+
+{NOMENCLATURE}
+
+С уважением,
+ООО "Клиент", ИНН 7701234567
+
+=== ВЛОЖЕНИЯ ===
+"""
+
+EXPECTED_PRODUCTS = [("Отвод 57х3", 4), ("Кран шаровой", 2), ("Электроды УОНИ", 15)]
+
+
+def _products(text: str) -> list:
+    return [(p["name"], p["quantity"]) for p in main.fallback_extract_products_new(text)]
+
+
+def test_forwarded_order_below_sign_off_is_kept():
+    reduced, _ = main.reduce_email_for_gpt(FORWARDED_ORDER)
+    assert "Электроды УОНИ\nкг\n15" in reduced
+    assert "ИНН 7701234567" in reduced
+    assert _products(reduced) == _products(FORWARDED_ORDER) == EXPECTED_PRODUCTS
+
+
+def test_nomenclature_block_in_signature_is_kept_whole():
+    text = f"""=== ТЕКСТ ПИСЬМА ===
+Добрый день, нужен счёт.
+
+С уважением,
+Иван Петров
+
+{NOMENCLATURE}
+
+Это сообщение конфиденциально и предназначено исключительно для адресата.
+"""
+    reduced, _ = main.reduce_email_for_gpt(text)
+    assert _products(reduced) == EXPECTED_PRODUCTS
+    assert "конфиденциально" not in reduced
+
+
+def test_reply_history_and_duplicates_are_dropped():
+    text = """=== ТЕКСТ ПИСЬМА ===
+Добрый день.
+
+Прошу выставить счёт на трубу 57х3,5 - 10 м. ООО "Ромашка", ИНН 7701234567
+
+Прошу выставить счёт на трубу 57х3,5 - 10 м. ООО "Ромашка", ИНН 7701234567
+
+-----Original Message-----
+Добрый день, вышлите, пожалуйста, заявку.
+> Труба 57х3,5 - 10 м
+
+=== ВЛОЖЕНИЯ ===
+"""
+    reduced, saved = main.reduce_email_for_gpt(text)
+    assert reduced.count("Прошу выставить счёт") == 1
+    assert "Original Message" not in reduced
+    assert saved > 0
+
+
+def test_quote_with_the_only_products_is_kept():
+    text = """=== ТЕКСТ ПИСЬМА ===
+Согласовано, выставляйте. ИНН 7701234567
+
+-----Original Message-----
+Труба 57х3,5 - 10 м
+Отвод 90 - 5 шт
+
+=== ВЛОЖЕНИЯ ===
+"""
+    reduced, _ = main.reduce_email_for_gpt(text)
+    assert "Труба 57х3,5 - 10 м" in reduced
+
+
+def test_attachment_keeps_only_relevant_paragraphs():
+    text = """=== ТЕКСТ ПИСЬМА ===
+Заявка во вложении.
+
+=== ВЛОЖЕНИЯ ===
+
+--- СОДЕРЖИМОЕ ВЛОЖЕНИЯ: заявка.docx ---
+Уважаемые коллеги, благодарим за сотрудничество.
+
+Труба 57х3,5 - 10 м
+
+ИНН 7701234567
+"""
+    reduced, _ = main.reduce_email_for_gpt(text)
+    assert "--- СОДЕРЖИМОЕ ВЛОЖЕНИЯ: заявка.docx ---" in reduced
+    assert "Труба 57х3,5 - 10 м" in reduced and "ИНН 7701234567" in reduced
+    assert "благодарим" not in reduced
@@ -0,0 +1,91 @@
+import io
+
+import pytest
+
+import main
+
+openpyxl = pytest.importorskip("openpyxl")
+
+ORDER_HTML = """<html><head><title>Заявка</title></head><body>
+<p>Добрый день, просим выставить счёт.</p>
+<table>
+  <tr><td>Спецификация к договору</td></tr>
+  <tr><th>№</th><th>Наименование товара</th><th>Кол-во</th><th>Ед. изм.</th></tr>
+  <tr><td>1</td><td>Труба 57х3,5</td><td>10</td><td>м</td></tr>
+  <tr><td>2</td><td>Отвод 90</td><td>5 шт</td><td></td></tr>
+  <tr><td>3</td><td>Фланец Ду50</td><td>по запросу</td><td>шт</td></tr>
+  <tr><td></td><td>Итого</td><td>15</td><td></td></tr>
+</table>
+<table><tr><td>Телефон</td><td>+7 900 000-00-00</td></tr></table>
+</body></html>"""
+
+ORDER_PRODUCTS = [
+    {"name": "Труба 57х3,5", "code": "", "quantity": 10, "sum": 0.0, "unit": "м"},
+    {"name": "Отвод 90", "code": "", "quantity": 5, "sum": 0.0, "unit": "шт"},
+]
+
+
+def test_header_detection():
+    assert main.detect_product_columns(["№", "Наименование товара", "Кол-во", "Ед. изм.", "Артикул"]) == \
+        {"name": 1, "quantity": 2, "unit": 3, "code": 4}
+    assert main.detect_product_columns(["Description", "QTY"]) == {"name": 0, "quantity": 1}
+    # Без колонки количества это не таблица товаров
+    assert main.detect_product_columns(["Наименование", "Цена"]) is None
+    assert main.detect_product_columns([None, "", "Итого"]) is None
+
+
+def test_html_table_becomes_products():
+    text, products = main._html_to_text_and_products_bs4(ORDER_HTML)
+    assert products == ORDER_PRODUCTS
+    assert "[Таблица товаров: 2 позиций передано напрямую]" in text
+    # Неразобранная строка остаётся в тексте вместе с шапкой, итоги отбрасываются
+    assert "Фланец Ду50\tпо запросу" in text and "Наименование товара" in text
+    assert "Итого" not in text
+    assert "Спецификация к договору" in text and "+7 900 000-00-00" in text
+
+
+def test_lxml_matches_html_parser():
+    pytest.importorskip("lxml.html")
+    assert main._html_to_text_and_products_lxml(ORDER_HTML) == main._html_to_text_and_products_bs4(ORDER_HTML)
+
+
+def test_html_without_header_stays_text():
+    html = "<table><tr><td>Труба 57х3,5</td><td>10</td></tr></table>"
+    assert main._html_to_text_and_products_bs4(html) == ("Труба 57х3,5\n10", [])
+
+
+def _xlsx(rows: list) -> bytes:
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = "Заявка"
+    for row in rows:
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def test_xlsx_header_below_title_rows():
+    payload = _xlsx([["ООО \"Клиент\""], [], ["Наименование", "Количество", "Ед.изм."],
+                     ["Труба 57х3,5", 10, "м"], ["Отвод 90", "5 шт", None], ["Фланец Ду50", "уточнить", "шт"]])
+    products = []
+    text = "".join(main.iter_xlsx_text(payload, products))
+    assert products == ORDER_PRODUCTS
+    # Строки над шапкой остаются текстом (openpyxl дополняет их пустыми ячейками до ширины листа)
+    assert text.startswith("\nЛист: Заявка\nООО \"Клиент\"\t\t\n")
+    assert "Наименование\tКоличество\tЕд.изм.\nФланец Ду50\tуточнить\tшт\n" in text
+    assert text.endswith("[Таблица товаров: 2 позиций передано напрямую]\n")
+
+
+def test_xlsx_without_products_argument_is_plain_text():
+    payload = _xlsx([["Наименование", "Количество"], ["Труба 57х3,5", 10]])
+    assert "".join(main.iter_xlsx_text(payload)) == "\nЛист: Заявка\nНаименование\tКоличество\nТруба 57х3,5\t10\n"
+
+
+def test_xlsx_header_beyond_scan_rows_is_not_detected():
+    rows = [[f"строка {i}"] for i in range(main.TABLE_HEADER_SCAN_ROWS)]
+    payload = _xlsx(rows + [["Наименование", "Количество"], ["Труба 57х3,5", 10]])
+    products = []
+    text = "".join(main.iter_xlsx_text(payload, products))
+    assert products == []
+    assert "Труба 57х3,5\t10\n" in text